@@ -0,0 +1,681 @@
+#!/usr/bin/python
+
+# This is a non-executable module, which contains the page classifier. The classifier
+# is trained once on the sample URLs of a website and then scores every crawled page
+# against the samples with the DFT distance of their tag signals, see KastParsersLib.
+
+# Programmer: Shirshendu Chakrabarti
+# Created at: 2011-August-09
+# Modified  : 2011-August-09
+
+# Import System module dependencies here.
+
+import os # Provides OS system calls interface.
+import time # Timing of the cascade filter, see evaluateCascade.
+import cPickle # Serialization of trained models.
+import gzip # Compressed sample page cache.
+import hashlib # md5, for the sample page cache file names.
+import heapq # Nearest neighbour search in the ball tree.
+from numpy import * # Signal histograms, spectra and the template index.
+
+# Import Internal modules dependencies here.
+
+import KastParsersLib # Custom parsing module, provides the tag signals and DFTs.
+import KastGenericFunctionsLib # Custom module for handy generic functions.
+
+# This class is a trained classification model. It is built once from the sample
+# pages of a website and caches everything about them that does not depend on the
+# page being classified, so that classifying a page only transforms that page:
+#
+# 1. The tag vocabulary of the website, see KastParsersLib.TagVocabulary, seeded
+#    with the tags of the sample pages in sorted order. Pages being classified are
+#    encoded with it without growing it, their tags which no sample has get codes
+#    after the vocabulary, so a page scores the same whatever was classified before.
+# 2. The tag encoded signal of every sample.
+# 3. The DFT magnitudes of every sample, for every DFT length asked for so far.
+#    Signals of unequal length are compared with power of 2 DFTs, see
+#    KastParsersLib.dftSpectrumLength, so a handful of lengths covers a whole crawl.
+# 4. The threshold, the mean similarity of the sample pages among themselves, along
+#    with their similarity matrix.
+#
+# A model can be saved to disk and loaded back, see loadOrTrainModel. A CascadeFilter
+# can be set as its cascade, to reject the obvious mismatches before scoring them.
+
+class SpectralModel:
+
+  cascade = None
+
+  def __init__(self, sampleUrls, sampleTagSeries):
+
+    self.sampleUrls = list(sampleUrls)
+
+    # Assign the codes in sorted tag order, so that a model is reproducible.
+
+    tags = set()
+    for rt in sampleTagSeries:
+      for t in rt:
+        if t[2] == 'els':
+          tags.add(t[1])
+
+    self.vocabulary = KastParsersLib.TagVocabulary(sorted(tags))
+    self.signals = [self.encode(rt) for rt in sampleTagSeries]
+
+    # (sample index, DFT length) --> DFT magnitudes
+
+    self.spectra = {}
+
+    self.threshold = self.calculateThreshold()
+
+  # This function encodes a tag series with the vocabulary of the website.
+
+  def encode(self, rt):
+
+    return self.vocabulary.encode(rt, grow=False)
+
+  # The DFT magnitudes of sample i, zero padded to length n.
+
+  def spectrum(self, i, n):
+
+    key = (i, n)
+
+    if key not in self.spectra:
+      self.spectra[key] = KastParsersLib.dftMagnitudes(self.signals[i], n)
+
+    return self.spectra[key]
+
+  # The similarity of an encoded signal to sample i, same as dftSimilarity. The DFT
+  # magnitudes of the signal are looked up in, and added to, pageSpectra if given.
+
+  def sampleSimilarity(self, i, d, pageSpectra=None):
+
+    n = KastParsersLib.dftSpectrumLength(len(self.signals[i]), len(d))
+
+    if n == 0:
+      return 1.0
+
+    if pageSpectra is None:
+      pageSpectra = {}
+
+    if n not in pageSpectra:
+      pageSpectra[n] = KastParsersLib.dftMagnitudes(d, n)
+
+    distance = KastParsersLib.parsevalDistance(self.spectrum(i, n), pageSpectra[n], n)
+
+    return 1/(1 + distance)
+
+  # The mean similarity of all the pairs of samples. The similarity matrix of the
+  # samples and the standard deviation are kept as well.
+
+  def calculateThreshold(self):
+
+    self.similarities = KastParsersLib.dftSimilarityMatrix(self.signals)
+    mean, self.thresholdStd = KastParsersLib.similarityThresholds(self.similarities)
+
+    return mean
+
+  # The mean similarity of an encoded signal to the samples. Samples of about the same
+  # length share a DFT length, the signal is transformed once for each of them.
+
+  def scoreSignal(self, d):
+
+    pageSpectra = {}
+
+    return KastGenericFunctionsLib.calcAvg([self.sampleSimilarity(i, d, pageSpectra) for i in range(0, len(self.signals))])
+
+  # The mean similarity of a page, given as a tag series, to the samples.
+
+  def score(self, rt):
+
+    return self.scoreSignal(self.encode(rt))
+
+  # This function classifies a page, given as a tag series. Returns (score, True if
+  # the page scores at least the threshold). A page rejected by the cascade is not
+  # scored, its score is None.
+
+  def verdict(self, rt):
+
+    d = self.encode(rt)
+
+    if self.cascade is not None and not self.cascade.admits(d):
+      return None, False
+
+    s = self.scoreSignal(d)
+
+    return s, s >= self.threshold
+
+  def isInteresting(self, rt):
+
+    return self.verdict(rt)[1]
+
+  def save(self, filename):
+
+    f = file(filename, 'wb')
+    cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+# This function returns the first topK DFT magnitudes of an encoded signal over its
+# own length, per tag: a fixed length, low frequency outline of the page, whatever
+# its length. Rather than transform the whole signal it is averaged down to 4*topK
+# blocks first, which keeps the low frequencies, and only the blocks are transformed.
+
+def spectralOutline(d, topK):
+
+  d = asarray(d, float)
+  blocks = 4*topK
+
+  o = zeros(topK)
+
+  if len(d) >= blocks:
+    edges = (arange(blocks)*len(d))/blocks
+    m = KastParsersLib.dftMagnitudes(add.reduceat(d, edges)/diff(append(edges, len(d))))[:topK]/blocks
+    o[:len(m)] = m
+  elif len(d) > 0:
+    m = KastParsersLib.dftMagnitudes(d)[:topK]/len(d)
+    o[:len(m)] = m
+
+  return o
+
+# The default tolerances of the cascade filter. A page is rejected by the length stage
+# if it is more than CASCADELENGTHRATIO times shorter than the shortest sample or
+# longer than the longest, by the histogram stage if its tag histogram is less
+# similar to every sample than CASCADEHISTOGRAMSLACK times the least similar pair
+# of samples, and by the spectrum stage if its first CASCADETOPK spectral
+# coefficients are further from every sample than CASCADESPECTRUMSLACK times the
+# furthest pair of samples. Loosen them for higher recall, tighten them to score
+# fewer pages.
+
+CASCADELENGTHRATIO = 3.0
+CASCADEHISTOGRAMSLACK = 0.9
+CASCADESPECTRUMSLACK = 2.0
+CASCADETOPK = 32
+
+# This class is a cascade of cheap tests run on a page before it is scored, see
+# SpectralModel.verdict. Each stage rejects the pages which are structurally
+# nothing like any sample, such as listings and help pages, and only the pages
+# which pass all of them pay for the exact DFT similarity:
+#
+# 1. The length of the tag signal, compared with the lengths of the samples.
+# 2. The tag histogram, the number of times each start tag occurs, compared with
+#    those of the samples by cosine similarity.
+# 3. The first topK DFT magnitudes of the signal over its own length, per tag, a
+#    low frequency outline of the page, compared with those of the samples by
+#    Euclidean distance.
+#
+# The histogram and spectrum thresholds are learned from how far apart the samples
+# are from each other, so with a single sample those stages let every page through.
+# The pages rejected by every stage are counted, see __str__ and evaluateCascade.
+
+class CascadeFilter:
+
+  def __init__(self, model, lengthRatio=CASCADELENGTHRATIO, histogramSlack=CASCADEHISTOGRAMSLACK, spectrumSlack=CASCADESPECTRUMSLACK, topK=CASCADETOPK):
+
+    self.lengthRatio = lengthRatio
+    self.histogramSlack = histogramSlack
+    self.spectrumSlack = spectrumSlack
+    self.topK = topK
+
+    # Tags no sample has all go into one last bin.
+
+    self.bins = len(model.vocabulary) + 2
+
+    lengths = [len(d) for d in model.signals]
+
+    self.minLength = min(lengths)/lengthRatio
+    self.maxLength = max(lengths)*lengthRatio
+
+    self.histograms = array([self.histogram(d) for d in model.signals])
+    self.outlines = array([self.outline(d) for d in model.signals])
+
+    self.histogramFloor = 0.0
+    self.spectrumRadius = inf
+
+    if len(model.signals) > 1:
+
+      # The similarity of every sample to the closest other sample.
+
+      similarities = dot(self.histograms, self.histograms.T)
+      fill_diagonal(similarities, -inf)
+      self.histogramFloor = histogramSlack*similarities.max(1).min()
+
+      distances = sqrt(((self.outlines[:, newaxis, :] - self.outlines[newaxis, :, :])**2).sum(2))
+      fill_diagonal(distances, inf)
+      self.spectrumRadius = spectrumSlack*distances.min(1).max()
+
+    self.passed = 0
+    self.rejected = {'length' : 0, 'histogram' : 0, 'spectrum' : 0}
+
+  # The tag histogram of a signal, normalized to unit length.
+
+  def histogram(self, d):
+
+    d = asarray(d)
+    h = bincount(minimum(d[d > 0], self.bins - 1), minlength=self.bins).astype(float)
+
+    norm = sqrt(dot(h, h))
+    if norm > 0:
+      h = h/norm
+
+    return h
+
+  def outline(self, d):
+
+    return spectralOutline(d, self.topK)
+
+  # This function runs a page, given as an encoded signal, through the stages. Returns
+  # False as soon as one rejects it.
+
+  def admits(self, d):
+
+    if not self.minLength <= len(d) <= self.maxLength:
+      self.rejected['length'] = self.rejected['length'] + 1
+      return False
+
+    if dot(self.histograms, self.histogram(d)).max() < self.histogramFloor:
+      self.rejected['histogram'] = self.rejected['histogram'] + 1
+      return False
+
+    if sqrt(((self.outlines - self.outline(d))**2).sum(1)).min() > self.spectrumRadius:
+      self.rejected['spectrum'] = self.rejected['spectrum'] + 1
+      return False
+
+    self.passed = self.passed + 1
+
+    return True
+
+  def __str__(self):
+
+    return 'passed=%d rejected: length=%d histogram=%d spectrum=%d' % (self.passed, self.rejected['length'], self.rejected['histogram'], self.rejected['spectrum'])
+
+# This function measures a cascade filter against the exact scorer of its model on a
+# list of tag series, e.g. pages of an earlier crawl. The exact verdict of every page
+# is taken as the truth, and as a page which passes the cascade is scored exactly
+# the precision of the cascade is always 1, what matters is its recall, the share
+# of the pages of interest it lets through. Returns a dictionary with the recall,
+# the share of the pages the cascade rejects and the time per page both ways.
+
+def evaluateCascade(model, cascade, tagSeries):
+
+  signals = [model.encode(rt) for rt in tagSeries]
+
+  start = time.time()
+  exact = [model.scoreSignal(d) >= model.threshold for d in signals]
+  exactTime = time.time() - start
+
+  # The counters of the cascade cover every page it ever saw, the pages rejected
+  # here are counted apart.
+
+  start = time.time()
+  passes = []
+  admitted = []
+  for d in signals:
+    passed = cascade.admits(d)
+    passes.append(passed)
+    admitted.append(passed and model.scoreSignal(d) >= model.threshold)
+  cascadeTime = time.time() - start
+
+  truePositives = len([1 for e, a in zip(exact, admitted) if e and a])
+  positives = len([1 for e in exact if e])
+  rejected = len([1 for passed in passes if not passed])
+
+  result = {}
+  result['pages'] = len(signals)
+  result['positives'] = positives
+  result['precision'] = 1.0
+  result['recall'] = 1.0
+  if positives > 0:
+    result['recall'] = float(truePositives)/positives
+  result['rejected'] = 0.0
+  if signals:
+    result['rejected'] = float(rejected)/len(signals)
+    result['exactTimePerPage'] = exactTime/len(signals)
+    result['cascadeTimePerPage'] = cascadeTime/len(signals)
+
+  return result
+
+# The number of points in a leaf of a ball tree.
+
+BALLTREELEAFSIZE = 16
+
+# This class is a ball tree over a set of points, for exact k nearest neighbour
+# lookups in sub-linear time. Every node is a ball, a centre and a radius, holding
+# all the points below it, split in two along the coordinate they spread the most
+# over. A lookup descends to the nearest ball first, and skips every ball which is
+# further away than the k nearest points found so far. The number of distances
+# worked out is kept in distanceCount.
+
+class BallTree:
+
+  def __init__(self, points, leafSize=BALLTREELEAFSIZE):
+
+    self.points = asarray(points, float)
+    self.leafSize = leafSize
+    self.distanceCount = 0
+    self.root = self.build(arange(len(self.points)))
+
+  # A node is (centre, radius, point indexes of a leaf or None, left, right).
+
+  def build(self, indexes):
+
+    p = self.points[indexes]
+    centre = p.mean(0)
+    radius = sqrt(((p - centre)**2).sum(1)).max()
+
+    if len(indexes) <= self.leafSize:
+      return (centre, radius, indexes, None, None)
+
+    dimension = (p.max(0) - p.min(0)).argmax()
+    indexes = indexes[p[:, dimension].argsort()]
+    half = len(indexes)/2
+
+    return (centre, radius, None, self.build(indexes[:half]), self.build(indexes[half:]))
+
+  # This function returns the k nearest points to x, as a list of (distance, index)
+  # tuples, nearest first.
+
+  def query(self, x, k=1):
+
+    x = asarray(x, float)
+
+    # A heap of (-distance, index), the furthest of the nearest points on top.
+
+    nearest = []
+
+    self.search(self.root, x, k, nearest)
+
+    return sorted([(-d, i) for d, i in nearest])
+
+  def search(self, node, x, k, nearest):
+
+    centre, radius, indexes, left, right = node
+
+    if indexes is not None:
+      distances = sqrt(((self.points[indexes] - x)**2).sum(1))
+      self.distanceCount = self.distanceCount + len(indexes)
+      for d, i in zip(distances, indexes):
+        if len(nearest) < k:
+          heapq.heappush(nearest, (-d, i))
+        elif d < -nearest[0][0]:
+          heapq.heapreplace(nearest, (-d, i))
+      return
+
+    children = []
+    for child in (left, right):
+      children.append((sqrt(((child[0] - x)**2).sum()) - child[1], child))
+    self.distanceCount = self.distanceCount + 2
+
+    children.sort(key=lambda c: c[0])
+
+    for bound, child in children:
+      if len(nearest) < k or bound < -nearest[0][0]:
+        self.search(child, x, k, nearest)
+
+# The number of spectral coefficients a template index works with, and the number of
+# nearest samples which vote on the template of a page.
+
+TEMPLATETOPK = 8
+TEMPLATENEIGHBOURS = 5
+
+# A page further from the nearest sample of its template than TEMPLATEDISTANCESLACK
+# times the radius of the template, the largest distance from a sample of it to the
+# nearest other one, is like none of the templates, and labeled TEMPLATEUNKNOWN.
+
+TEMPLATEDISTANCESLACK = 1.5
+TEMPLATEUNKNOWN = 'unknown'
+
+# This class is a classifier for websites with several kinds of pages, templates
+# such as product, listing or review pages, each with its own samples. Rather than
+# comparing a page with every sample it looks up the nearest samples in a BallTree
+# of their spectral outlines, see spectralOutline, and labels the page with the
+# template most of the k nearest belong to, the nearest breaking ties. A page too far
+# from the samples of that template, see TEMPLATEDISTANCESLACK, is labeled
+# TEMPLATEUNKNOWN instead. The pages of the templates in interesting are of interest.
+#
+# It classifies like a SpectralModel does, see verdict, so it can be used in place
+# of one, e.g. with classifyFiles.
+
+class TemplateIndex:
+
+  def __init__(self, templateUrls, templateTagSeries, interesting, topK=TEMPLATETOPK, k=TEMPLATENEIGHBOURS, leafSize=BALLTREELEAFSIZE, slack=TEMPLATEDISTANCESLACK):
+
+    self.templateUrls = dict(templateUrls)
+    self.interesting = set(interesting)
+    self.topK = topK
+    self.k = k
+    self.slack = slack
+
+    # One vocabulary for all the templates, in sorted tag order as SpectralModel does.
+
+    tags = set()
+    for name in templateTagSeries:
+      for rt in templateTagSeries[name]:
+        for t in rt:
+          if t[2] == 'els':
+            tags.add(t[1])
+
+    self.vocabulary = KastParsersLib.TagVocabulary(sorted(tags))
+
+    self.labels = []
+    outlines = []
+
+    for name in sorted(templateTagSeries):
+      for rt in templateTagSeries[name]:
+        self.labels.append(name)
+        outlines.append(spectralOutline(self.vocabulary.encode(rt, grow=False), topK))
+
+    # The coefficients are standardized over the samples, otherwise the few largest,
+    # the lowest frequencies, would decide the distances on their own.
+
+    outlines = array(outlines)
+    self.mean = outlines.mean(0)
+    self.scale = outlines.std(0)
+    self.scale[self.scale == 0] = 1.0
+
+    points = (outlines - self.mean)/self.scale
+    self.tree = BallTree(points, leafSize)
+
+    # The radius of every template, from the distance of each of its samples to the
+    # nearest other sample of it. A template with a single sample gets the largest
+    # radius of the others.
+
+    labels = array(self.labels)
+    self.radius = {}
+
+    for name in set(self.labels):
+      members = points[labels == name]
+      if len(members) > 1:
+        distances = sqrt(((members[:, newaxis, :] - members[newaxis, :, :])**2).sum(2))
+        fill_diagonal(distances, inf)
+        self.radius[name] = float(distances.min(1).max())
+
+    for name in set(self.labels):
+      if name not in self.radius:
+        self.radius[name] = max(self.radius.values() or [inf])
+
+  # The point of a page, given as a tag series, in the index.
+
+  def features(self, rt):
+
+    return (spectralOutline(self.vocabulary.encode(rt, grow=False), self.topK) - self.mean)/self.scale
+
+  # This function labels a page, given as a tag series. Returns (template, distance
+  # to the nearest sample of that template).
+
+  def nearest(self, rt):
+
+    neighbours = self.tree.query(self.features(rt), self.k)
+
+    votes = {}
+    for d, i in neighbours:
+      votes[self.labels[i]] = votes.get(self.labels[i], 0) + 1
+
+    # The neighbours are nearest first, so the first label with the most votes is
+    # also the nearest of them.
+
+    most = max(votes.values())
+    for d, i in neighbours:
+      if votes[self.labels[i]] == most:
+        return self.labels[i], d
+
+  # Returns (template, True if the template is of interest), the template being
+  # TEMPLATEUNKNOWN for a page like none of them.
+
+  def verdict(self, rt):
+
+    name, d = self.nearest(rt)
+
+    if d > self.slack*self.radius[name]:
+      name = TEMPLATEUNKNOWN
+
+    return name, name in self.interesting
+
+  def isInteresting(self, rt):
+
+    return self.verdict(rt)[1]
+
+  def save(self, filename):
+
+    f = file(filename, 'wb')
+    cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+# This function loads a model saved with SpectralModel.save.
+
+def loadModel(filename):
+
+  f = file(filename, 'rb')
+  model = cPickle.load(f)
+  f.close()
+
+  return model
+
+# This function returns the tag signal of a sample page. With a cache folder the page
+# is kept there, gzipped, once fetched, so that retraining does not download the
+# samples again.
+
+def sampleTagSignal(url, sampleCacheDir=None):
+
+  if sampleCacheDir is None:
+    return KastParsersLib.html2TagSignal(url)
+
+  cacheFile = sampleCacheDir + hashlib.md5(url).hexdigest() + '.gz'
+
+  if not os.path.exists(cacheFile):
+    r = KastParsersLib.fetchURL(url)
+    if r == '':
+      return []
+    f = gzip.open(cacheFile, 'wb')
+    f.write(r)
+    f.close()
+
+  f = file(cacheFile, 'rb')
+  rt = KastParsersLib.content2TagSignal(f)
+  f.close()
+
+  return rt
+
+# This exception is raised when sample pages could not be fetched, or have no tags,
+# so that no model is trained, and saved for later runs, on part of the samples.
+
+class SampleError(Exception):
+
+  def __init__(self, urls):
+
+    Exception.__init__(self, 'No tag signal for sample URLs: ' + ', '.join(urls))
+    self.urls = urls
+
+# This function returns the tag signals of a list of sample URLs, see sampleTagSignal.
+# Raises SampleError if any of them is empty.
+
+def sampleTagSignals(urls, sampleCacheDir=None):
+
+  signals = [sampleTagSignal(url, sampleCacheDir) for url in urls]
+
+  failed = [url for url, rt in zip(urls, signals) if len(rt) == 0]
+  if failed:
+    raise SampleError(failed)
+
+  return signals
+
+# This function returns the model of a website. If a model trained on the same sample
+# URLs was saved to modelFile it is loaded, else the sample pages are fetched, or
+# taken from sampleCacheDir, a new model is trained and saved to modelFile. If a
+# sample page cannot be had SampleError is raised and nothing is trained.
+
+def loadOrTrainModel(sampleUrls, modelFile, sampleCacheDir=None):
+
+  if os.path.exists(modelFile):
+    model = loadModel(modelFile)
+    if getattr(model, 'sampleUrls', None) == list(sampleUrls):
+      return model
+
+  sampleTagSeries = sampleTagSignals(sampleUrls, sampleCacheDir)
+
+  model = SpectralModel(sampleUrls, sampleTagSeries)
+  model.save(modelFile)
+
+  return model
+
+# This function returns the template index of a website, as loadOrTrainModel does
+# for a model: templateUrls maps the name of every template to its sample URLs. If a
+# sample page of any template cannot be had SampleError is raised. An index saved
+# before templates had a radius is trained again.
+
+def loadOrTrainTemplateIndex(templateUrls, interesting, modelFile, sampleCacheDir=None, slack=TEMPLATEDISTANCESLACK):
+
+  if os.path.exists(modelFile):
+    index = loadModel(modelFile)
+    if getattr(index, 'templateUrls', None) == templateUrls and hasattr(index, 'radius'):
+      index.interesting = set(interesting)
+      index.slack = slack
+      return index
+
+  templateTagSeries = {}
+  failed = []
+  for name in templateUrls:
+    try:
+      templateTagSeries[name] = sampleTagSignals(templateUrls[name], sampleCacheDir)
+    except SampleError, e:
+      failed.extend(e.urls)
+
+  if failed:
+    raise SampleError(failed)
+
+  index = TemplateIndex(templateUrls, templateTagSeries, interesting, slack=slack)
+  index.save(modelFile)
+
+  return index
+
+# The model of a classification worker process, shipped once to every worker by
+# initClassifierWorker rather than with every page.
+
+workerModel = None
+
+def initClassifierWorker(model):
+
+  global workerModel
+
+  workerModel = model
+
+# This function scores one page against the model of the worker. The page is a (key,
+# content) tuple, the content anything KastParsersLib.content2TagSignal takes.
+# Returns (key, score, True if the page is of interest), see SpectralModel.verdict,
+# where the score of a TemplateIndex is the template of the page.
+
+def classifyPage(page):
+
+  key, content = page
+
+  s, interesting = workerModel.verdict(KastParsersLib.content2TagSignal(content))
+
+  return key, s, interesting
+
+# This function classifies (key, content) pages, e.g. the items of a page store, and
+# yields a (key, score, verdict) tuple for every page as soon as it is done. With
+# more than one process the pages are sharded over a pool of worker processes, each
+# of which gets the model once, and the verdicts come back in the order they finish.
+# Only a batch of the pages is ever held in memory, see
+# KastGenericFunctionsLib.poolMap.
+
+def classifyPages(model, pages, processes=None, chunksize=16):
+
+  return KastGenericFunctionsLib.poolMap(classifyPage, pages, processes, initClassifierWorker, (model,), chunksize)
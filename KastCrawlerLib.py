@@ -0,0 +1,910 @@
+#!/usr/bin/python
+
+# This is a non-executable module, which contains the building blocks of the crawl
+# engine: the URL frontier, the politeness scheduler, the concurrent fetcher, the
+# page store, near-duplicate detection and the crawl statistics.
+# The crawl loop itself lives in crawler.py and only drives these pieces.
+
+# Programmer: Shirshendu Chakrabarti
+# Created at: 2011-August-02
+# Modified  : 2011-August-02
+
+# Import System module dependencies here.
+
+import time # Provides time operations
+import threading # Worker threads for the concurrent fetcher
+import Queue # Thread safe queues for handing work to the workers
+import urlparse # URL parsing, used to extract the host of a URL
+import collections # deque, for the frontier queue
+import sqlite3 # On disk store for the persistent frontier
+import array # Compact machine word arrays, for the fingerprint set
+import struct # Packing/unpacking of binary data
+import hashlib # md5, for URL fingerprints, sha1, for page content hashes
+import os # File sizes and paths of the page store segments
+import zlib # Compression of the page store records
+import uuid # WARC record ids
+import base64 # WARC block digests
+import re # Tokenizing pages for SimHash
+import cPickle # Saving the near-duplicate index
+import numpy # Bit counting for SimHash
+
+# The fingerprint set stores fingerprints in unsigned longs, which are 64-bit on
+# the 64-bit Linux boxes we crawl from. Anywhere else they are truncated to fit.
+
+FINGERPRINTTYPECODE = 'L'
+FINGERPRINTMASK = (1 << (8*array.array(FINGERPRINTTYPECODE).itemsize)) - 1
+
+# Import Internal modules dependencies here.
+
+import KastParsersLib # Custom parsing module, provides the fetch functions.
+
+# This function extracts the host part of a URL, lowercased.
+
+def getHost(url):
+
+  return urlparse.urlsplit(url)[1].lower()
+
+# This class is the URL frontier, the set of pages still to be crawled. URLs are
+# handed out in the order they were discovered, i.e. BFS, from a deque, and every
+# URL ever added is remembered in a hash set, so a URL is queued at most once in
+# the whole crawl whether it is still waiting or already crawled. add(), pop() and
+# the membership test are all constant time.
+
+class UrlFrontier:
+
+  def __init__(self, urls=[], seen=None):
+
+    self.queue = collections.deque()
+
+    # Anything with add() and the in operator will do as the seen set, e.g. a
+    # FingerprintSet when the crawl is too large to keep every URL string around.
+
+    if seen is None:
+      seen = set()
+    self.seen = seen
+
+    for url in urls:
+      self.add(url)
+
+  # Queue up a URL, returns False if it was already seen.
+
+  def add(self, url):
+
+    if url in self.seen:
+      return False
+
+    self.seen.add(url)
+    self.queue.append(url)
+
+    return True
+
+  # Hand out the next URL to crawl.
+
+  def pop(self):
+
+    return self.queue.popleft()
+
+  # Number of URLs waiting to be crawled.
+
+  def __len__(self):
+
+    return len(self.queue)
+
+  # True if the URL was ever added, crawled or not.
+
+  def __contains__(self, url):
+
+    return url in self.seen
+
+  # Mark a popped URL as crawled. Nothing to do for an in-memory frontier.
+
+  def done(self, url):
+
+    pass
+
+  # Make the frontier state durable. Nothing to do for an in-memory frontier.
+
+  def checkpoint(self):
+
+    pass
+
+  def close(self):
+
+    pass
+
+# This class is a compact set of URLs, for keeping track of tens of millions of seen
+# URLs in a fixed memory budget. Instead of the URL we keep a 64-bit fingerprint of
+# it, the first 8 bytes of its md5, in an open addressing hash table with linear
+# probing backed by an array of machine words. That is 8 bytes a slot instead of the
+# hundreds of bytes a URL string costs in a set. Two URLs with the same fingerprint
+# are taken to be the same URL, with 64 bits the chance of that is about n/2**64
+# per lookup for a set of n URLs. The table doubles once it is more than maxLoad
+# full, so pass the expected number of URLs as capacity to allocate it up front.
+
+class FingerprintSet:
+
+  def __init__(self, capacity=1 << 20, maxLoad=0.75):
+
+    self.maxLoad = maxLoad
+    self.count = 0
+
+    size = 1
+    while size*maxLoad < capacity:
+      size = size << 1
+
+    self.allocate(size)
+
+  # Allocate an empty table of size slots, size is a power of 2. 0 marks an empty slot.
+
+  def allocate(self, size):
+
+    self.size = size
+    self.mask = size - 1
+    self.limit = int(size*self.maxLoad)
+    self.table = array.array(FINGERPRINTTYPECODE, [0])*size
+
+  # The fingerprint of a URL, never 0 since that marks an empty slot.
+
+  def fingerprint(self, url):
+
+    if isinstance(url, unicode):
+      url = url.encode('utf-8')
+
+    f = struct.unpack('<Q', hashlib.md5(url).digest()[:8])[0] & FINGERPRINTMASK
+
+    return f or 1
+
+  # Return the slot holding fingerprint f, or the empty slot where it would go.
+
+  def slot(self, f):
+
+    table = self.table
+    mask = self.mask
+    i = f & mask
+
+    while (1):
+      v = table[i]
+      if v == 0 or v == f:
+        return i
+      i = (i + 1) & mask
+
+  # Double the table and reinsert all the fingerprints.
+
+  def grow(self):
+
+    old = self.table
+    self.allocate(self.size << 1)
+
+    for f in old:
+      if f != 0:
+        self.table[self.slot(f)] = f
+
+  def add(self, url):
+
+    f = self.fingerprint(url)
+    i = self.slot(f)
+
+    if self.table[i] == 0:
+      self.table[i] = f
+      self.count = self.count + 1
+      if self.count > self.limit:
+        self.grow()
+
+  def __contains__(self, url):
+
+    f = self.fingerprint(url)
+
+    return self.table[self.slot(f)] == f
+
+  def __len__(self):
+
+    return self.count
+
+  # Memory taken by the table, in bytes.
+
+  def memoryUsage(self):
+
+    return self.size*self.table.itemsize
+
+# This class is a frontier kept in a sqlite database, so that memory stays bounded
+# however large the site is and a crawl that was killed can be resumed. Every URL
+# ever added is a row, with its state: waiting, in flight or done. Rows are handed
+# out in insertion order, so the crawl is still BFS. The database is committed every
+# checkpointEvery operations and on checkpoint(), so a crash loses at most that much
+# work. When a frontier is reopened, the URLs that were in flight are put back in
+# the queue.
+
+class PersistentUrlFrontier:
+
+  WAITING = 0
+  INFLIGHT = 1
+  DONE = 2
+
+  def __init__(self, filename, urls=[], checkpointEvery=1000):
+
+    self.filename = filename
+    self.checkpointEvery = checkpointEvery
+    self.pendingWrites = 0
+
+    self.db = sqlite3.connect(filename)
+    self.db.text_factory = str
+    self.db.execute('CREATE TABLE IF NOT EXISTS frontier (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT UNIQUE NOT NULL, state INTEGER NOT NULL)')
+
+    # Requeue whatever was in flight when the last run stopped.
+
+    self.db.execute('UPDATE frontier SET state = ? WHERE state = ?', (self.WAITING, self.INFLIGHT))
+    self.db.commit()
+
+    # The head is the id of the last row handed out, rows are handed out in id order.
+
+    head = self.db.execute('SELECT MIN(id) FROM frontier WHERE state = ?', (self.WAITING,)).fetchone()[0]
+    if head is None:
+      self.head = self.db.execute('SELECT COALESCE(MAX(id), 0) FROM frontier').fetchone()[0]
+    else:
+      self.head = head - 1
+
+    self.waiting = self.db.execute('SELECT COUNT(*) FROM frontier WHERE state = ?', (self.WAITING,)).fetchone()[0]
+
+    for url in urls:
+      self.add(url)
+
+  # Commit once enough changes have piled up.
+
+  def wrote(self):
+
+    self.pendingWrites = self.pendingWrites + 1
+    if self.pendingWrites >= self.checkpointEvery:
+      self.checkpoint()
+
+  # Queue up a URL, returns False if it was already seen.
+
+  def add(self, url):
+
+    c = self.db.execute('INSERT OR IGNORE INTO frontier (url, state) VALUES (?, ?)', (url, self.WAITING))
+    if c.rowcount != 1:
+      return False
+
+    self.waiting = self.waiting + 1
+    self.wrote()
+
+    return True
+
+  # Hand out the next URL to crawl.
+
+  def pop(self):
+
+    row = self.db.execute('SELECT id, url FROM frontier WHERE id > ? AND state = ? ORDER BY id LIMIT 1', (self.head, self.WAITING)).fetchone()
+    if row is None:
+      raise IndexError('pop from an empty frontier')
+
+    self.head = row[0]
+    self.db.execute('UPDATE frontier SET state = ? WHERE id = ?', (self.INFLIGHT, row[0]))
+    self.waiting = self.waiting - 1
+    self.wrote()
+
+    return row[1]
+
+  # Mark a popped URL as crawled.
+
+  def done(self, url):
+
+    self.db.execute('UPDATE frontier SET state = ? WHERE url = ?', (self.DONE, url))
+    self.wrote()
+
+  # Number of URLs waiting to be crawled.
+
+  def __len__(self):
+
+    return self.waiting
+
+  # True if the URL was ever added, crawled or not.
+
+  def __contains__(self, url):
+
+    return self.db.execute('SELECT 1 FROM frontier WHERE url = ?', (url,)).fetchone() is not None
+
+  # Number of URLs crawled so far, across all the runs.
+
+  def crawled(self):
+
+    return self.db.execute('SELECT COUNT(*) FROM frontier WHERE state = ?', (self.DONE,)).fetchone()[0]
+
+  def checkpoint(self):
+
+    self.db.commit()
+    self.pendingWrites = 0
+
+  def close(self):
+
+    self.checkpoint()
+    self.db.close()
+
+# SimHash settings: the number of tokens in a shingle, and the number of bits two
+# SimHashes of near-duplicate pages may differ in at most.
+
+SHINGLESIZE = 4
+NEARDUPLICATEDISTANCE = 3
+
+# The least Jaccard similarity of the shingles of a page and the stored copy of its
+# SimHash match for the page to be taken for a near duplicate, see shingleSimilarity.
+
+NEARDUPLICATESIMILARITY = 0.9
+
+# The tokens of a page for SimHash: tag names and words, so that both the layout and
+# the text of the page count.
+
+SIMHASHTOKEN = re.compile(r'<[^\s>]+|\w+')
+
+# This function returns the set of distinct shingles of shingleSize tokens of a page.
+
+def pageShingles(content, shingleSize=SHINGLESIZE):
+
+  tokens = SIMHASHTOKEN.findall(content.lower())
+
+  return set([' '.join(tokens[i:i + shingleSize]) for i in range(0, max(len(tokens) - shingleSize + 1, 1))])
+
+# This function returns the Jaccard similarity of the shingle sets of two pages, the
+# exact measure a SimHash distance estimates.
+
+def shingleSimilarity(content1, content2, shingleSize=SHINGLESIZE):
+
+  s1 = pageShingles(content1, shingleSize)
+  s2 = pageShingles(content2, shingleSize)
+
+  return len(s1 & s2) / float(max(len(s1 | s2), 1))
+
+# This function calculates the 64-bit SimHash of a page: the page is cut into
+# overlapping shingles of shingleSize tokens, every distinct shingle is hashed to 64
+# bits, and bit i of the SimHash is set if bit i is set in more than half of the
+# shingle hashes. Pages which differ only here and there, in a tracking parameter in a link,
+# a session id or a sort order, get SimHashes which differ in a few bits only.
+
+def simHash(content, shingleSize=SHINGLESIZE):
+
+  # Every distinct shingle counts once, else the shingles a page repeats over and over,
+  # the markup of a menu for one, would outvote all the others.
+
+  shingles = pageShingles(content, shingleSize)
+
+  # The first 8 bytes of the md5 of every shingle, read straight into 64-bit words.
+
+  hashes = numpy.frombuffer(''.join([hashlib.md5(shingle).digest()[:8] for shingle in shingles]), '<u8')
+
+  # The number of shingle hashes with bit i set, for every i.
+
+  counts = numpy.zeros(64, int)
+  for i in range(0, len(hashes), 4096):
+    block = hashes[i:i + 4096]
+    counts = counts + ((block[:, numpy.newaxis] >> numpy.arange(64, dtype=numpy.uint64)) & numpy.uint64(1)).sum(0)
+
+  h = 0
+  for bit in range(0, 64):
+    if 2*counts[bit] > len(hashes):
+      h = h | (1 << bit)
+
+  return h
+
+# The number of bits two SimHashes differ in.
+
+def hammingDistance(h1, h2):
+
+  return bin(h1 ^ h2).count('1')
+
+# This class is an index of the SimHashes of the pages crawled so far, for finding
+# the near duplicates of a page, those whose SimHashes differ in at most maxDistance
+# bits. The 64 bits are split into bands, maxDistance + 1 of them by default, and
+# every band has a table from its bits to the pages. Two SimHashes which differ in
+# at most maxDistance bits agree in at least one band, so only the pages which share
+# a band with the page are compared with it, not all of them.
+
+class SimHashIndex:
+
+  def __init__(self, maxDistance=NEARDUPLICATEDISTANCE, bands=None):
+
+    if bands is None:
+      bands = maxDistance + 1
+
+    self.maxDistance = maxDistance
+
+    # (shift, mask) of every band.
+
+    self.bands = []
+    for i in range(0, bands):
+      start = 64*i/bands
+      end = 64*(i + 1)/bands
+      self.bands.append((start, (1 << (end - start)) - 1))
+
+    self.tables = [{} for band in self.bands]
+
+    # url --> SimHash, of every page in the index.
+
+    self.hashes = {}
+
+  def keys(self, h):
+
+    return [(h >> shift) & mask for shift, mask in self.bands]
+
+  # This function returns the URL of a near duplicate of a page, given its SimHash
+  # and URL, or None if there is none. A page is not a duplicate of itself.
+
+  def lookup(self, h, url=None):
+
+    candidates = self.candidates(h, url)
+    if candidates:
+      return candidates[0]
+
+    return None
+
+  # This function returns the URLs of all the near duplicates of a page, nearest first.
+
+  def candidates(self, h, url=None):
+
+    found = {}
+
+    for table, key in zip(self.tables, self.keys(h)):
+      for other, otherUrl in table.get(key, []):
+        if otherUrl != url and otherUrl not in found:
+          distance = hammingDistance(h, other)
+          if distance <= self.maxDistance:
+            found[otherUrl] = distance
+
+    return sorted(found, key=lambda otherUrl: (found[otherUrl], otherUrl))
+
+  # This function adds a page to the index, in place of what it was when last crawled.
+
+  def add(self, h, url):
+
+    if url in self.hashes:
+      self.remove(url)
+
+    for table, key in zip(self.tables, self.keys(h)):
+      table.setdefault(key, []).append((h, url))
+
+    self.hashes[url] = h
+
+  def remove(self, url):
+
+    h = self.hashes.pop(url)
+
+    for table, key in zip(self.tables, self.keys(h)):
+      table[key].remove((h, url))
+      if table[key] == []:
+        del table[key]
+
+  def __len__(self):
+
+    return len(self.hashes)
+
+  def save(self, filename):
+
+    f = file(filename, 'wb')
+    cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+# This function loads a SimHash index saved with SimHashIndex.save, a new one if there
+# is no such file yet or if it was made for another maxDistance.
+
+def loadSimHashIndex(filename, maxDistance=NEARDUPLICATEDISTANCE):
+
+  if not os.path.exists(filename):
+    return SimHashIndex(maxDistance)
+
+  f = file(filename, 'rb')
+  index = cPickle.load(f)
+  f.close()
+
+  if index.maxDistance != maxDistance:
+    return SimHashIndex(maxDistance)
+
+  return index
+
+# The size past which the page store starts a new segment file.
+
+SEGMENTSIZE = 1 << 30
+
+# The number of URLs the page store reads from its index at a time, see urls.
+
+URLBATCHSIZE = 1000
+
+# This class is the page store, where the crawled pages are kept. Pages are appended
+# to a few large segment files instead of a file each, every page as a WARC/1.0
+# resource record in a gzip member of its own, so that the segments can be read by
+# any WARC tool and any record can be decompressed on its own. Pages are keyed by
+# the SHA-1 of their content, a page which is already stored, under any URL, is
+# not stored again.
+#
+# An sqlite index next to the segments maps every URL to the hash of its page, and
+# every hash to the segment, offset and length of its record, so a page is read
+# with one lookup and one seek. A URL also has a label, '' for the pages of
+# interest, see crawler.py, which classification changes without touching the
+# record. Segments are flushed before the index is committed, so the index never
+# points past the end of a segment.
+
+class PageStore:
+
+  def __init__(self, directory, segmentSize=SEGMENTSIZE, commitEvery=1000):
+
+    self.directory = directory
+    self.segmentSize = segmentSize
+    self.commitEvery = commitEvery
+    self.pendingWrites = 0
+
+    self.db = sqlite3.connect(directory + 'pages.index')
+    self.db.text_factory = str
+    self.db.execute('CREATE TABLE IF NOT EXISTS pages (hash TEXT PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT NOT NULL, label TEXT NOT NULL, fetched REAL NOT NULL)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS urls_label ON urls (label)')
+    self.db.commit()
+
+    # Carry on appending to the last segment.
+
+    self.segment = self.db.execute('SELECT COALESCE(MAX(segment), 0) FROM pages').fetchone()[0]
+    self.openSegment()
+
+    # Segments open for reading, segment number --> file.
+
+    self.readers = {}
+
+  def segmentFile(self, segment):
+
+    return self.directory + 'segment-%05d.warc.gz' % segment
+
+  def openSegment(self):
+
+    filename = self.segmentFile(self.segment)
+    self.writer = file(filename, 'ab')
+    self.offset = 0
+    if os.path.exists(filename):
+      self.offset = os.path.getsize(filename)
+
+  # Commit once enough changes have piled up.
+
+  def wrote(self):
+
+    self.pendingWrites = self.pendingWrites + 1
+    if self.pendingWrites >= self.commitEvery:
+      self.checkpoint()
+
+  # This function appends a page as a WARC record to the current segment, starting a
+  # new segment if it is full. Returns (segment, offset, length) of the record.
+
+  def append(self, url, content, h):
+
+    if self.offset >= self.segmentSize:
+      self.writer.close()
+      self.segment = self.segment + 1
+      self.openSegment()
+
+    header = ['WARC/1.0',
+              'WARC-Type: resource',
+              'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+              'WARC-Date: %s' % time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'WARC-Target-URI: %s' % url,
+              'WARC-Block-Digest: sha1:%s' % base64.b32encode(h.decode('hex')),
+              'Content-Type: text/html',
+              'Content-Length: %d' % len(content)]
+
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    record = c.compress('\r\n'.join(header) + '\r\n\r\n') + c.compress(content) + c.compress('\r\n\r\n') + c.flush()
+
+    self.writer.write(record)
+
+    location = (self.segment, self.offset, len(record))
+    self.offset = self.offset + len(record)
+
+    return location
+
+  # This function stores the page of a URL. Returns True if the content was new to
+  # the store, False if it was already there, under this or any other URL.
+
+  def put(self, url, content, label=''):
+
+    if isinstance(content, unicode):
+      content = content.encode('utf-8')
+
+    h = hashlib.sha1(content).hexdigest()
+
+    new = self.db.execute('SELECT 1 FROM pages WHERE hash = ?', (h,)).fetchone() is None
+    if new:
+      segment, offset, length = self.append(url, content, h)
+      self.db.execute('INSERT INTO pages (hash, segment, offset, length) VALUES (?, ?, ?, ?)', (h, segment, offset, length))
+
+    self.db.execute('INSERT OR REPLACE INTO urls (url, hash, label, fetched) VALUES (?, ?, ?, ?)', (url, h, label, time.time()))
+    self.wrote()
+
+    return new
+
+  # This function reads the page with the given content hash.
+
+  def getByHash(self, h):
+
+    row = self.db.execute('SELECT segment, offset, length FROM pages WHERE hash = ?', (h,)).fetchone()
+    if row is None:
+      return None
+
+    segment, offset, length = row
+
+    if segment == self.segment:
+      self.writer.flush()
+
+    if segment not in self.readers:
+      self.readers[segment] = file(self.segmentFile(segment), 'rb')
+
+    f = self.readers[segment]
+    f.seek(offset)
+    record = zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+
+    header, content = record.split('\r\n\r\n', 1)
+    for line in header.split('\r\n'):
+      if line.startswith('Content-Length:'):
+        content = content[:int(line.split(':')[1])]
+
+    return content
+
+  # This function reads the page of a URL, None if there is none.
+
+  def get(self, url):
+
+    h = self.hash(url)
+    if h is None:
+      return None
+
+    return self.getByHash(h)
+
+  # The content hash of the page of a URL, None if there is none.
+
+  def hash(self, url):
+
+    row = self.db.execute('SELECT hash FROM urls WHERE url = ?', (url,)).fetchone()
+    if row is None:
+      return None
+
+    return row[0]
+
+  def label(self, url):
+
+    row = self.db.execute('SELECT label FROM urls WHERE url = ?', (url,)).fetchone()
+    if row is None:
+      return None
+
+    return row[0]
+
+  def relabel(self, url, label):
+
+    self.db.execute('UPDATE urls SET label = ? WHERE url = ?', (label, url))
+    self.wrote()
+
+  # This function yields the URLs in the store in order, only those with the given
+  # label if there is one. They are read batchSize at a time, each batch starting
+  # after the last URL of the one before, so memory stays bounded and the store can
+  # be written to, or a URL relabeled, between two batches without one being skipped.
+
+  def urls(self, label=None, batchSize=URLBATCHSIZE):
+
+    last = ''
+
+    while (1):
+
+      if label is None:
+        rows = self.db.execute('SELECT url FROM urls WHERE url > ? ORDER BY url LIMIT ?', (last, batchSize)).fetchall()
+      else:
+        rows = self.db.execute('SELECT url FROM urls WHERE label = ? AND url > ? ORDER BY url LIMIT ?', (label, last, batchSize)).fetchall()
+
+      for row in rows:
+        yield row[0]
+
+      if len(rows) < batchSize:
+        return
+
+      last = rows[-1][0]
+
+  # This function yields (url, content) for the URLs in the store, only those with
+  # the given label if there is one, see urls.
+
+  def items(self, label=None):
+
+    for url in self.urls(label):
+      content = self.get(url)
+      if content is not None:
+        yield url, content
+
+  def __len__(self):
+
+    return self.db.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+
+  def __contains__(self, url):
+
+    return self.hash(url) is not None
+
+  def checkpoint(self):
+
+    self.writer.flush()
+    self.db.commit()
+    self.pendingWrites = 0
+
+  def close(self):
+
+    self.checkpoint()
+    self.writer.close()
+    for f in self.readers.values():
+      f.close()
+    self.readers = {}
+    self.db.close()
+
+# This class is a per-host token bucket scheduler. Every host gets a bucket which
+# refills at 1/delay tokens a second and holds at most burst tokens. A fetch takes a
+# token, and if the bucket is empty the caller sleeps until its token is due, so that
+# no host sees more than 1/delay requests a second on average however many workers
+# we run.
+
+class HostScheduler:
+
+  def __init__(self, delay=1.0, burst=1):
+
+    self.delay = float(delay)
+    self.burst = float(burst)
+    self.lock = threading.Lock()
+
+    # host --> (tokens, time of last refill). Tokens may go negative, which means
+    # that many fetches are already queued up on this host.
+
+    self.buckets = {}
+
+  # Reserve a token for the host and return the number of seconds to wait for it.
+
+  def reserve(self, host):
+
+    if self.delay <= 0:
+      return 0.0
+
+    self.lock.acquire()
+    try:
+      now = time.time()
+      tokens, last = self.buckets.get(host, (self.burst, now))
+      tokens = min(self.burst, tokens + (now - last)/self.delay)
+      tokens = tokens - 1
+      self.buckets[host] = (tokens, now)
+    finally:
+      self.lock.release()
+
+    if tokens >= 0:
+      return 0.0
+
+    return -tokens*self.delay
+
+  # Block until the host of this url may be fetched again.
+
+  def acquire(self, url):
+
+    wait = self.reserve(getHost(url))
+    if wait > 0:
+      time.sleep(wait)
+
+# This class keeps the counters of a crawl, so that the fetcher can be tuned under
+# real load. All updates are done under a lock since the workers share it.
+
+class FetchStats:
+
+  def __init__(self):
+
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.inFlight = 0
+    self.fetched = 0
+    self.errors = 0
+    self.notModified = 0
+    self.bytes = 0
+
+  def fetchStarted(self):
+
+    self.lock.acquire()
+    self.inFlight = self.inFlight + 1
+    self.lock.release()
+
+  # Count a finished fetch, r is the content, '' on error and None if the page was
+  # not modified since the last crawl.
+
+  def fetchDone(self, r):
+
+    self.lock.acquire()
+    self.inFlight = self.inFlight - 1
+    self.fetched = self.fetched + 1
+    if r is None:
+      self.notModified = self.notModified + 1
+    elif r == '':
+      self.errors = self.errors + 1
+    else:
+      self.bytes = self.bytes + len(r)
+    self.lock.release()
+
+  def pagesPerSecond(self):
+
+    elapsed = time.time() - self.started
+    if elapsed <= 0:
+      return 0.0
+
+    return self.fetched/elapsed
+
+  def __str__(self):
+
+    return 'fetched=%d errors=%d notmodified=%d inflight=%d bytes=%d pages/sec=%.2f' % (self.fetched, self.errors, self.notModified, self.inFlight, self.bytes, self.pagesPerSecond())
+
+# This class is the concurrent fetcher. It runs a fixed number of worker threads,
+# each of which takes a URL off the request queue, waits for the politeness
+# scheduler and fetches it with the fetch function, KastParsersLib.fetchURL unless
+# told otherwise. Results are handed back as (url, content) tuples through the
+# result queue, in completion order. A URL submitted with conditional False is
+# fetched with conditional=False, so that the fetch function skips the validators
+# of the last crawl.
+
+class FetchPool:
+
+  def __init__(self, workers=8, scheduler=None, stats=None, fetch=None):
+
+    self.workers = workers
+    self.fetch = fetch or KastParsersLib.fetchURL
+    self.scheduler = scheduler or HostScheduler()
+    self.stats = stats or FetchStats()
+    self.requests = Queue.Queue()
+    self.results = Queue.Queue()
+    self.pending = 0
+    self.threads = []
+
+    for i in range(0, workers):
+      t = threading.Thread(target=self.work)
+      t.setDaemon(True)
+      t.start()
+      self.threads.append(t)
+
+  # The worker loop, a None request shuts the worker down.
+
+  def work(self):
+
+    while (1):
+
+      request = self.requests.get()
+      if request is None:
+        return
+
+      url, conditional = request
+
+      self.scheduler.acquire(url)
+      self.stats.fetchStarted()
+      if conditional:
+        r = self.fetch(url)
+      else:
+        r = self.fetch(url, conditional=False)
+      self.stats.fetchDone(r)
+      self.results.put((url, r))
+
+  # Hand a URL to the workers.
+
+  def submit(self, url, conditional=True):
+
+    self.pending = self.pending + 1
+    self.requests.put((url, conditional))
+
+  # Return True if there is room for one more request, we keep exactly as many
+  # requests outstanding as there are workers.
+
+  def hasCapacity(self):
+
+    return self.pending < self.workers
+
+  # Block for the next finished fetch, returns (url, content).
+
+  def next(self):
+
+    result = self.results.get()
+    self.pending = self.pending - 1
+
+    return result
+
+  # Stop all the workers.
+
+  def close(self):
+
+    for t in self.threads:
+      self.requests.put(None)
+    for t in self.threads:
+      t.join()
@@ -9,6 +9,13 @@
 import os
 import sys
 import time
+import errno
+import itertools
+import multiprocessing
+
+# The buffer size of the files records are written to, see writeToDisk.
+
+WRITEBUFFERSIZE = 1 << 20
 
 # This function is a generic log fucntion which records exception events.
 
@@ -34,11 +41,39 @@ def chkmkFolderStructure(folderStruct):
 
   return folderStruct
 
+# This function writes a lock file holding the process id of this process.
+
+def makeLockFile(lockFile):
+
+  f = file(lockFile, 'w')
+  f.write(str(os.getpid()) + '\n')
+  f.close()
+
+# This function checks if a lock file was left behind by a process that is no longer
+# running, e.g. a crawl that was killed. Lock files without a process id are never
+# considered stale.
+
+def isStaleLockFile(lockFile):
+
+  f = file(lockFile, 'r')
+  pid = f.read().strip()
+  f.close()
+
+  if not pid.isdigit():
+    return False
+
+  try:
+    os.kill(int(pid), 0)
+  except OSError, err:
+    return err.errno == errno.ESRCH
+
+  return False
+
 # This function extracts the website name from FQDN
 
 def extractWebSiteName(targetWebsite):
 
-  websiteName = targetWebsite.split('http://')[1]
+  websiteName = targetWebsite.split('://', 1)[1]
 
   return websiteName
 
@@ -51,20 +86,63 @@ def calcAvg(aList):
 
   return float(sumOfListMembers)/float(lengthOfList)
 
-# This function writes an array of records to the disk.
+# This function writes records to the disk, a line each. The file is opened once and
+# written through a buffer of bufferSize bytes, and records can be any iterable, a
+# generator included, so they are written as they are produced and need not all be
+# held in memory.
+
+def writeToDisk(logFile, records, bufferSize=WRITEBUFFERSIZE):
+
+  f = file(logFile, 'a', bufferSize)
 
-def writeToDisk(logFile, records):
+  try:
 
-  for record in records:
+    for record in records:
 
-    f = file(logFile, 'a')
+      # Strip the brackets of the list.
 
-    record = str(record)
+      record = str(record)[1:-1]
 
-    record = record.split(']')[0]
-    record = record.split('[')[1]
+      f.write(record + '\n')
 
-    f.write(record + '\n')
+  finally:
 
     f.close()
 
+# This function maps a function over items with a pool of processes, every one of
+# them set up with initializer(*initargs), and yields the results as they come in,
+# in the order of the items if ordered is True. The items are handed to the pool a
+# batch at a time, so only a batch of them and of their results is ever held in
+# memory however many there are. With one process, or None, it all happens here.
+
+def poolMap(function, items, processes=None, initializer=None, initargs=(), chunksize=16, ordered=False):
+
+  if processes is None or processes <= 1:
+    if initializer is not None:
+      initializer(*initargs)
+    for item in items:
+      yield function(item)
+    return
+
+  pool = multiprocessing.Pool(processes, initializer, initargs)
+
+  imap = pool.imap_unordered
+  if ordered:
+    imap = pool.imap
+
+  items = iter(items)
+  batchSize = 4*processes*chunksize
+
+  try:
+    while 1:
+      batch = list(itertools.islice(items, batchSize))
+      if batch == []:
+        break
+      for result in imap(function, batch, chunksize):
+        yield result
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
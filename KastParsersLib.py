@@ -15,6 +15,35 @@ import random # Random module for random number generation and operations.
 
 import urllib2
 from urllib2 import urlopen
+import httplib
+import socket
+import threading
+
+# Compression module, for gzip/deflate transfer encoding.
+
+import zlib
+
+# md5, for record GUIDs.
+
+import hashlib
+
+# Serialization, for saving tag vocabularies.
+
+import cPickle
+
+# Process pool, for computing similarity matrices in parallel.
+
+import multiprocessing
+
+# Embedded database, for the HTTP metadata store.
+
+import sqlite3
+
+# URL parsing and canonicalization
+
+import re
+import urllib
+import urlparse
 
 # Extremely fast HTML/XML Parser
 
@@ -29,6 +58,7 @@ import ast
 
 import pyquery
 from pyquery import PyQuery as pq
+from pyquery.cssselectpatch import JQueryTranslator
 
 # String Module for specialized string operations.
 
@@ -72,6 +102,266 @@ def fetchURL(url):
     print str(err)
     return ''
 
+# Maximum number of redirects followed by fetchURLPooled.
+
+MAXREDIRECTS = 5
+
+# Socket timeout, in seconds, of the pooled connections.
+
+FETCHTIMEOUT = 30
+
+# This class is a pool of persistent HTTP connections. Idle connections are kept per
+# (scheme, host) so that a fetch from a host we talked to before does not pay the
+# TCP (and SSL) setup again. Safe to share between fetch threads.
+
+class ConnectionPool:
+
+  def __init__(self, timeout=FETCHTIMEOUT, maxIdle=4):
+
+    self.timeout = timeout
+    self.maxIdle = maxIdle
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  # Return a connection to the host, and whether it is a reused one.
+
+  def get(self, scheme, host):
+
+    self.lock.acquire()
+    try:
+      conns = self.idle.get((scheme, host), [])
+      if conns != []:
+        return conns.pop(), True
+    finally:
+      self.lock.release()
+
+    if scheme == 'https':
+      return httplib.HTTPSConnection(host, timeout=self.timeout), False
+
+    return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+  # Hand a connection back for reuse.
+
+  def put(self, scheme, host, conn):
+
+    self.lock.acquire()
+    try:
+      conns = self.idle.setdefault((scheme, host), [])
+      if len(conns) < self.maxIdle:
+        conns.append(conn)
+        return
+    finally:
+      self.lock.release()
+
+    conn.close()
+
+  def close(self):
+
+    self.lock.acquire()
+    try:
+      for conns in self.idle.values():
+        for conn in conns:
+          conn.close()
+      self.idle = {}
+    finally:
+      self.lock.release()
+
+# This class stores the validators, ETag and Last-Modified, that a server sent with
+# a page, keyed by URL, so that a recrawl can issue a conditional GET and skip the
+# pages which did not change. Kept in a sqlite database, safe to share between
+# fetch threads. The validators of a fetch are only staged, under the URL that was
+# asked for, until the page is known to be stored, see confirm and discard, since a
+# page we send a conditional GET for has to be in the page store.
+
+class FetchMetadataStore:
+
+  def __init__(self, filename, commitEvery=100):
+
+    self.commitEvery = commitEvery
+    self.pendingWrites = 0
+    self.staged = {}
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.text_factory = str
+    self.db.execute('CREATE TABLE IF NOT EXISTS metadata (url TEXT PRIMARY KEY, etag TEXT, lastmodified TEXT)')
+    self.db.commit()
+
+  # Return (etag, lastModified) for the URL, None for the ones we do not have.
+
+  def get(self, url):
+
+    self.lock.acquire()
+    try:
+      row = self.db.execute('SELECT etag, lastmodified FROM metadata WHERE url = ?', (url,)).fetchone()
+    finally:
+      self.lock.release()
+
+    if row is None:
+      return None, None
+
+    return row[0], row[1]
+
+  def put(self, url, etag, lastModified):
+
+    self.lock.acquire()
+    try:
+      self.db.execute('INSERT OR REPLACE INTO metadata (url, etag, lastmodified) VALUES (?, ?, ?)', (url, etag, lastModified))
+      self.pendingWrites = self.pendingWrites + 1
+      if self.pendingWrites >= self.commitEvery:
+        self.db.commit()
+        self.pendingWrites = 0
+    finally:
+      self.lock.release()
+
+  # Hold on to the validators of url, fetched for the requested URL, the two differ
+  # after a redirect.
+
+  def stage(self, requested, url, etag, lastModified):
+
+    self.lock.acquire()
+    try:
+      self.staged.setdefault(requested, []).append((url, etag, lastModified))
+    finally:
+      self.lock.release()
+
+  # The page fetched for the requested URL was stored, keep its validators.
+
+  def confirm(self, requested):
+
+    self.lock.acquire()
+    try:
+      staged = self.staged.pop(requested, [])
+    finally:
+      self.lock.release()
+
+    for url, etag, lastModified in staged:
+      self.put(url, etag, lastModified)
+
+  # The page fetched for the requested URL was not stored, forget its validators.
+
+  def discard(self, requested):
+
+    self.lock.acquire()
+    try:
+      self.staged.pop(requested, None)
+    finally:
+      self.lock.release()
+
+  def close(self):
+
+    self.lock.acquire()
+    try:
+      self.db.commit()
+      self.db.close()
+    finally:
+      self.lock.release()
+
+# This function decodes a gzip or deflate encoded response body.
+
+def decodeContent(body, encoding):
+
+  encoding = (encoding or '').strip().lower()
+
+  if encoding in ('gzip', 'x-gzip'):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+  if encoding == 'deflate':
+
+    # Servers disagree on whether deflate means a zlib stream or a raw one.
+
+    try:
+      return zlib.decompress(body)
+    except zlib.error:
+      return zlib.decompress(body, -zlib.MAX_WBITS)
+
+  return body
+
+# This function sends one request on a connection from the pool and reads the whole
+# response, retrying once on a fresh connection if a reused one turns out to have
+# been closed by the server. Returns (status, headers, body).
+
+def pooledRequest(pool, scheme, host, path, headers):
+
+  for attempt in range(0, 2):
+
+    conn, reused = pool.get(scheme, host)
+
+    try:
+      conn.request('GET', path, headers=headers)
+      res = conn.getresponse()
+      body = res.read()
+    except (httplib.HTTPException, socket.error):
+      conn.close()
+      if reused:
+        continue
+      raise
+
+    if res.will_close:
+      conn.close()
+    else:
+      pool.put(scheme, host, conn)
+
+    return res.status, res, body
+
+# This is a helper function which fetches a URL over a persistent connection from
+# the pool, asking for gzip/deflate transfer encoding. If a metadata store is given
+# the request is made conditional on the validators seen on the last crawl, and
+# None is returned when the server says the page was not modified, unless
+# conditional is False, then every URL of the redirect chain is fetched afresh. The
+# validators of the response are staged in the metadata store, for the caller to
+# confirm once the page is stored. Like fetchURL, returns '' on any error.
+
+def fetchURLPooled(url, pool, metadata=None, conditional=True):
+
+  requested = url
+
+  try:
+
+    for redirect in range(0, MAXREDIRECTS + 1):
+
+      scheme, host, path, query, fragment = urlparse.urlsplit(url)
+      path = path or '/'
+      if query:
+        path = path + '?' + query
+
+      headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'}
+
+      if metadata is not None and conditional:
+        etag, lastModified = metadata.get(url)
+        if etag:
+          headers['If-None-Match'] = etag
+        if lastModified:
+          headers['If-Modified-Since'] = lastModified
+
+      status, res, body = pooledRequest(pool, scheme, host, path, headers)
+
+      if status in (301, 302, 303, 307, 308) and res.getheader('location'):
+        url = urlparse.urljoin(url, res.getheader('location'))
+        continue
+
+      if status == 304:
+        return None
+
+      if status != 200:
+        print url, status
+        return ''
+
+      if metadata is not None:
+        etag = res.getheader('etag')
+        lastModified = res.getheader('last-modified')
+        if etag or lastModified:
+          metadata.stage(requested, url, etag, lastModified)
+
+      return decodeContent(body, res.getheader('content-encoding'))
+
+    print url, 'too many redirects'
+    return ''
+
+  except Exception, err:
+
+    print str(err)
+    return ''
+
 # This is a helper function to clean HTML content, of all the whitespace.
 
 def cleanHtml(c):
@@ -99,19 +389,131 @@ def extractHyperlinks(listOfHyperlinks):
 
   return extractedHyperlinks
 
-# This function canonicalizes relative/absolute URLs to absolute URLs
+# Schemes we crawl, links with any other scheme (javascript:, mailto:, ftp: ...) are dropped.
+
+CRAWLABLESCHEMES = ('http', 'https')
+
+# Default ports, which are stripped off the host when canonicalizing.
+
+DEFAULTPORTS = {'http': '80', 'https': '443'}
+
+# The characters left as they are in the path of a canonical URL, all others are
+# percent encoded. Escapes already there are kept as they are.
+
+URLPATHSAFECHARACTERS = "/:@!$&'()*+,;=-._~%"
+URLQUERYSAFECHARACTERS = URLPATHSAFECHARACTERS + '?'
+
+# This function resolves the dot segments, . and .., of a URL path as in RFC 3986.
+
+def removeDotSegments(path):
+
+  segments = []
+
+  for segment in path.split('/'):
+    if segment == '..':
+      if len(segments) > 1:
+        segments.pop()
+    elif segment != '.':
+      segments.append(segment)
+
+  # A trailing . or .. still refers to a directory.
+
+  if path.endswith('/.') or path.endswith('/..'):
+    segments.append('')
+
+  return '/'.join(segments)
+
+# This function canonicalizes an absolute URL, so that URLs which differ only in
+# spelling compare equal: the scheme and host are lowercased, the default port and
+# the fragment are dropped, dot segments are resolved and the query parameters are
+# sorted by name. Since the canonical URL is the one fetched, the parameters are
+# otherwise kept as they are spelled, and the ones of the same name in their order.
+# Non ASCII characters are percent encoded as UTF-8, so a URL spelled either way
+# canonicalizes to the same byte string. Returns '' for URLs we do not crawl.
+
+def canonicalizeURL(url):
 
-def convert2AbsoluteHyperlinks(listOfHyperlinks, targetWebsiteUrl):
+  if isinstance(url, unicode):
+    url = url.encode('utf-8')
+
+  scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+  scheme = scheme.lower()
+
+  if scheme not in CRAWLABLESCHEMES or netloc == '':
+    return ''
+
+  # Lowercase the host but not the user info, and drop the default port.
+
+  userinfo, sep, host = netloc.rpartition('@')
+  host = host.lower()
+  if host.endswith(':' + DEFAULTPORTS[scheme]):
+    host = host.rsplit(':', 1)[0]
+  elif host.endswith(':'):
+    host = host[:-1]
+  netloc = userinfo + sep + host
+
+  # Resolve the dot segments, an empty path is the root.
+
+  path = urllib.quote(removeDotSegments(path) or '/', URLPATHSAFECHARACTERS)
+
+  # Sort the query parameters by name, a stable sort, dropping the empty ones.
+
+  if query:
+    parameters = [urllib.quote(p, URLQUERYSAFECHARACTERS) for p in query.split('&') if p != '']
+    query = '&'.join(sorted(parameters, key=lambda p: p.split('=', 1)[0]))
+
+  return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+# This function compiles a list of regular expression strings, as found in the config
+# file, for use with convert2AbsoluteHyperlinks.
+
+def compileUrlPatterns(patterns):
+
+  return [re.compile(p) for p in patterns]
+
+# This function canonicalizes relative/absolute URLs to absolute URLs. Links are
+# resolved against the URL of the page they were found on, pageUrl, which defaults
+# to the target website. Only links on the same host as the target website are
+# kept, and of those only the ones matching one of the includePatterns, if any are
+# given, and none of the excludePatterns. The result has no duplicates. A link which
+# cannot be canonicalized is skipped, and logged to errorLog if one is given.
+
+def convert2AbsoluteHyperlinks(listOfHyperlinks, targetWebsiteUrl, pageUrl=None, includePatterns=[], excludePatterns=[], errorLog=None):
+
+  if pageUrl is None:
+    pageUrl = targetWebsiteUrl
+
+  # A bare FQDN is the root page of the website.
+
+  baseUrl = canonicalizeURL(pageUrl)
+  targetHost = urlparse.urlsplit(canonicalizeURL(targetWebsiteUrl))[1]
 
   r2a = []
+  seen = set()
 
   for i in listOfHyperlinks:
-    if i.startswith('http://'):
-      r2a.append(i)
-    elif not i.startswith('http://') and i.startswith('/'):
-      r2a.append(targetWebsiteUrl + i)
-    elif not i.startswith('http://') and not i.startswith('/'):
-      r2a.append(targetWebsiteUrl + '/' + i)
+
+    try:
+      url = canonicalizeURL(urlparse.urljoin(baseUrl, i.strip()))
+    except Exception, e:
+      if errorLog is not None:
+        KastGenericFunctionsLib.logException('Bad hyperlink on ' + pageUrl + ': ' + repr(i) + ' ' + str(e) + ' - ' + str(time.time()), errorLog)
+      continue
+
+    if url == '' or url in seen:
+      continue
+
+    if urlparse.urlsplit(url)[1] != targetHost:
+      continue
+
+    if includePatterns and not [p for p in includePatterns if p.search(url)]:
+      continue
+
+    if [p for p in excludePatterns if p.search(url)]:
+      continue
+
+    seen.add(url)
+    r2a.append(url)
 
   return r2a
 
@@ -256,10 +658,99 @@ def getTagSetPositionStructure(tt):
 
   return tagHash
 
+# This class is a tag vocabulary, tag --> code, that stays the same from page to
+# page. tagEncoder derives the codes from the tags of the two pages being compared,
+# so a page's signal changes with every page it is compared with. With a vocabulary
+# every page is encoded once, to a numpy int array, and that signal can be compared
+# with the signal of any other page encoded with the same vocabulary. Codes are
+# handed out in the order tags are first seen and never change, so the vocabulary
+# can be grown page by page over a whole site and saved in between.
+
+class TagVocabulary:
+
+  def __init__(self, tags=[]):
+
+    self.codes = {}
+
+    for tag in tags:
+      self.add(tag)
+
+  # Return the code of a start tag, giving it the next free code if it is new.
+
+  def add(self, tag):
+
+    code = self.codes.get(tag)
+
+    if code is None:
+      code = len(self.codes) + 1
+      self.codes[tag] = code
+
+    return code
+
+  def __len__(self):
+
+    return len(self.codes)
+
+  def __contains__(self, tag):
+
+    return tag in self.codes
+
+  # This function encodes a tag series, as tagEncoder does: start tags get their code,
+  # end tags minus the code of their start tag, or 0 if there is none. Unless grow is
+  # False new start tags are added to the vocabulary. If it is they get codes after
+  # the vocabulary for this page only, leaving the vocabulary as it is.
+
+  def encode(self, rt, grow=True):
+
+    codes = self.codes
+    newCodes = {}
+    signal = []
+
+    for i in rt:
+      if i[2] == 'els':
+        code = codes.get(i[1])
+        if code is None:
+          if grow:
+            code = self.add(i[1])
+          else:
+            code = newCodes.setdefault(i[1], len(codes) + len(newCodes) + 1)
+        signal.append(code)
+      elif i[2] == 'ele':
+        tempEndTag = '<' + i[1].split('</')[1]
+        code = codes.get(tempEndTag) or newCodes.get(tempEndTag, 0)
+        signal.append(-code)
+
+    return array(signal, int32)
+
+  def save(self, filename):
+
+    f = file(filename, 'wb')
+    cPickle.dump(self.codes, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+# This function loads a vocabulary saved with TagVocabulary.save, an empty one if
+# there is no such file yet.
+
+def loadTagVocabulary(filename):
+
+  vocabulary = TagVocabulary()
+
+  if os.path.exists(filename):
+    f = file(filename, 'rb')
+    vocabulary.codes = cPickle.load(f)
+    f.close()
+
+  return vocabulary
+
 # This function performs the tag encoding of the html series. The encoding is based on
-# linear random assignment of numbers, all natural numbers.
+# linear random assignment of numbers, all natural numbers. If a TagVocabulary is
+# given the codes come from it instead of tnames, and a numpy int array is returned,
+# see TagVocabulary.encode.
+
+def tagEncoder(tnames, rt, vocabulary=None):
 
-def tagEncoder(tnames, rt):
+  if vocabulary is not None:
+    return vocabulary.encode(rt)
 
   # First obtain a dictionary of tagnames and their positions. This will help in
   # assigning amplitudes as values.
@@ -462,9 +953,13 @@ def zeroPad(ts, M):
 
   return ts
 
-# Calculate threshold score for classification
+# Calculate threshold score for classification. Given a TagVocabulary the pages are
+# encoded once with it and scored in one batch, see calculateSimilarityMatrix.
+
+def calculateThresholdDftDistanceScore(samplePages, vocabulary=None):
 
-def calculateThresholdDftDistanceScore(samplePages):
+  if vocabulary is not None:
+    return calculateSimilarityMatrix(samplePages, vocabulary)[1]
 
   # Arrange the series in an adjacency graph format to keep track of computation.
 
@@ -572,7 +1067,7 @@ def kastConfigFileParser(configFile):
 
 # This function populates the first level of URLs that needs to be used by the crawler.
 
-def populateUnseenUrlList(targetWebsiteUrl, unseenUrlList):
+def populateUnseenUrlList(targetWebsiteUrl, unseenUrlList, includePatterns=[], excludePatterns=[]):
 
   try:
 
@@ -597,7 +1092,7 @@ def populateUnseenUrlList(targetWebsiteUrl, unseenUrlList):
 
     # Convert to absolute links.
 
-    unseenUrlList = convert2AbsoluteHyperlinks(links_a, targetWebsiteUrl)
+    unseenUrlList = convert2AbsoluteHyperlinks(links_a, targetWebsiteUrl, targetWebsiteUrl, includePatterns, excludePatterns)
 
     return unseenUrlList
 
@@ -624,46 +1119,254 @@ def html2TagSignal(url):
 
   r = fetchURL(url)
 
-  # Clean the HTML content.
+  # Generate the tag signal in a single pass over the HTML content.
+
+  return htmlString2TagSignal(r)
+
+# The first two bytes of a gzip stream.
+
+GZIPMAGIC = '\x1f\x8b'
+
+# This function reads page content as it comes: a string, or a file object, and in
+# either case gzip compressed or not. Returns the HTML string.
+
+def readContent(content):
+
+  if hasattr(content, 'read'):
+    content = content.read()
+
+  if isinstance(content, str) and content.startswith(GZIPMAGIC):
+    content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
 
-  r = cleanHtml(r)
+  return content
 
-  # Strip the html page of any content and get a tupleof tags
-  # <p>Hi!</p> --> [(1, p)]
+# This function converts page content into its tag signal, like html2TagSignal does
+# with a URL. The content can be anything readContent takes, e.g. a page straight
+# out of a gzip file, so there is no need to go through a temporary file and a
+# file:// URL.
 
-  r_tags = getTagSet(r)
+def content2TagSignal(content):
 
-  # Deal with <script> tags separately, so that we dont have to deal with malformed
-  # html
+  return htmlString2TagSignal(readContent(content))
 
-  r_tags = sanitizeScriptTags(r_tags)
+# The whitespace characters that cleanHtml removes, i.e. all but the space.
 
-  # Convert all short hand tags which end with < /> to full tag set features
-  # <br /> --> <br></br>
+NONSPACEWHITESPACE = string.whitespace.replace(' ', '')
+NONSPACEWHITESPACEPATTERN = re.compile('[' + re.escape(NONSPACEWHITESPACE) + ']')
 
-  r_tags = convertShortHandTags(r_tags)
+# A tag, as getTagSet sees it: a '<' followed by anything up to the next '>'. Any
+# '<' in between is part of the tag, and a '>' outside a tag is ignored.
 
-  # Convert the attributes also into tags <a href="/"> --> <a>, <ATTRIB@href>,
-  # </ATTRIB@href>
+TAGPATTERN = re.compile('<[^>]*>')
 
-  r_tags = convertAttributes2Tag(r_tags)
+# This function converts an HTML string into its tag signal in a single pass. It
+# gives the same tag series that the original multi-stage pipeline gives, i.e.
+#
+#   cleanHtml --> getTagSet --> sanitizeScriptTags --> convertShortHandTags -->
+#   convertAttributes2Tag --> tagIdentifier --> removeCommentTags
+#
+# but instead of joining the tags back into a string and re-tokenizing after every
+# stage, each tag is run through all the stages as soon as the scanner finds it:
+#
+# 1. Whitespace other than the space is dropped, as cleanHtml does.
+# 2. The tags inside <script> elements are skipped.
+# 3. Short hand tags are expanded, <br /> --> <br>, </br>
+# 4. Attributes are converted to tags, <a href="/"> --> <a>, <attrib@href>,
+#    </attrib@href>
+# 5. Tags are marked as start (els), end (ele) or comment (elc) tags, and the
+#    comment tags are dropped.
 
-  # Now process for tag marking, identify start tags, end tags and comment tags.
-  # <html> --> els, </html> --> ele, <!-- comment --> --> elc
+def htmlString2TagSignal(r):
 
-  r_tags = tagIdentifier(r_tags)
+  # Drop all the whitespace but the space, like cleanHtml.
 
-  # Now remove the comment tags, they dont contribute to the html series and distort
-  # the score.
+  if isinstance(r, unicode):
+    r = NONSPACEWHITESPACEPATTERN.sub(u'', r)
+  else:
+    r = r.translate(None, NONSPACEWHITESPACE)
+
+  r_tags = []
+  count = 0
+  insideScriptTagContent = 0
+
+  for m in TAGPATTERN.finditer(r):
+
+    t = m.group().lower()
+
+    # Skip everything in between <script> and </script>.
+
+    if t.startswith('<script'):
+      if not t.endswith('/>'):
+        insideScriptTagContent = 1
+    elif t.startswith('</script') and insideScriptTagContent == 1:
+      insideScriptTagContent = 0
+    elif insideScriptTagContent == 1:
+      continue
+
+    # Expand short hand tags, <img src='example.png' /> --> <img src='example.png'>
+    # followed by </img>
+
+    if t.endswith('/>'):
+      tbct = t.split('/>')[0]
+      tags = (tbct.strip() + '>', '</' + tbct.split('<')[1].strip().split(' ')[0] + '>')
+    else:
+      tags = (t,)
+
+    for t in tags:
+
+      # End tags and comment tags carry no attributes.
+
+      if t.startswith('</'):
+        count = count + 1
+        r_tags.append((count, t, 'ele'))
+        continue
+      elif t.startswith('<!'):
+        count = count + 1
+        continue
+
+      # Split off the attributes. Every part that starts with '<', the tag name
+      # first of all, becomes a tag of its own, every part with an '=' becomes an
+      # attribute tag pair.
+
+      for i in t.split(' '):
+
+        if i.startswith('<'):
 
-  r_tags = removeCommentTags(r_tags)
+          # Only the last part ends with '>'.
+
+          if not i.endswith('>'):
+            i = i + '>'
+
+          count = count + 1
+          if i.startswith('</'):
+            r_tags.append((count, i, 'ele'))
+          elif not i.startswith('<!'):
+            r_tags.append((count, i, 'els'))
+
+        else:
+
+          if i.endswith('>'):
+            i = i.split('>')[0]
+
+          if i.__contains__('='):
+            attribName = i.split('=')[0].strip()
+            r_tags.append((count + 1, '<attrib@' + attribName + '>', 'els'))
+            r_tags.append((count + 2, '</attrib@' + attribName + '>', 'ele'))
+            count = count + 2
 
   return r_tags
 
+# This function checks if n only has 2, 3 and 5 as prime factors. numpy's FFT is
+# fast for such lengths, for lengths with larger prime factors it degrades towards
+# O(N^2), which is where bluesteinDFT comes in.
+
+def isSmooth(n):
+
+  for p in (2, 3, 5):
+    while n % p == 0:
+      n = n/p
+
+  return n == 1
+
+# This function calculates the N point DFT of any length N sequence in O(N log N)
+# with Bluestein's chirp-z algorithm: the DFT is rewritten as a convolution with a
+# chirp, which is done with power of 2 FFTs of length at least 2N - 1.
+
+def bluesteinDFT(x):
+
+  N = len(x)
+  n = arange(N)
+
+  # exp(-1j*pi*n^2/N), with n^2 reduced mod 2N to keep the angles small.
+
+  chirp = exp(-1j*pi*((n*n) % (2*N))/N)
+
+  M = next_pow(2*N - 2)
+
+  a = zeros(M, complex)
+  a[:N] = x*chirp
+
+  b = zeros(M, complex)
+  b[:N] = conj(chirp)
+  b[M - N + 1:] = conj(chirp[1:])[::-1]
+
+  return chirp*ifft(fft(a)*fft(b))[:N]
+
+# This function returns the length of the DFT used to compare two tag signals of
+# length l1 and l2. Equal length signals are compared as they are, else both are
+# zero padded past l1 + l2 - 1 to a power of 2, as dftDistance always did.
+
+def dftSpectrumLength(l1, l2):
+
+  if l1 == l2:
+    return l1
+
+  return next_pow(l1 + l2 - 1)
+
+# This function returns the DFT magnitudes of a real signal zero padded to length n.
+# Since the spectrum of a real signal is symmetric only the first n/2 + 1 of them
+# are returned, see parsevalDistance.
+
+def dftMagnitudes(d, n=None):
+
+  d = asarray(d, float)
+
+  if n is None:
+    n = len(d)
+
+  if isSmooth(n):
+    return abs(rfft(d, n))
+
+  x = zeros(n)
+  x[:len(d)] = d[:n]
+
+  return abs(bluesteinDFT(x)[:n/2 + 1])
+
+# This function returns the weights of the bins returned by dftMagnitudes for a
+# length n DFT. The bins which stand for two bins of the full spectrum weigh twice.
+
+def parsevalWeights(n):
+
+  w = empty(n/2 + 1)
+  w.fill(2.0)
+  w[0] = 1.0
+  if n % 2 == 0:
+    w[-1] = 1.0
+
+  return w
+
+# This function calculates the distance between two spectra as returned by
+# dftMagnitudes for a length n DFT, based on Parsevals Theorem.
+
+def parsevalDistance(m1, m2, n):
+
+  return sqrt(dot(parsevalWeights(n), (m1 - m2)**2))
+
+# This function calculates the DFT similarity of two tag encoded signals.
+
+def dftSimilarity(d1, d2):
+
+  n = dftSpectrumLength(len(d1), len(d2))
+
+  if n == 0:
+    return 1.0
+
+  distance = parsevalDistance(dftMagnitudes(d1, n), dftMagnitudes(d2, n), n)
+
+  # Similarity measure calculation
+
+  return 1/(1 + distance)
+
 # This function calculates the dft distance between two html documents and returns a score
-# of similarity.
+# of similarity. The DFTs are done with numpy's FFT, see dftSimilarity, instead of the
+# first principles calculateDFT and calculateIDFT, which are O(N^2) and give the
+# same scores. If a TagVocabulary is given the documents are encoded with it, for
+# many comparisons encode every document once with it and use dftSimilarity.
+
+def dftDistance(rt1, rt2, vocabulary=None):
 
-def dftDistance(rt1, rt2):
+  if vocabulary is not None:
+    return dftSimilarity(vocabulary.encode(rt1), vocabulary.encode(rt2))
 
   # Calculate the unique tname set for both the documents
 
@@ -674,48 +1377,352 @@ def dftDistance(rt1, rt2):
   d1 = tagEncoder(tnames, rt1)
   d2 = tagEncoder(tnames, rt2)
 
-  # Now proceed with DFT and interpolated DFT calculation based on length of the sequences.
+  return dftSimilarity(d1, d2)
+
+# This function returns the DFT magnitudes of a list of signals zero padded to length
+# n, one row per signal, doing all the FFTs in one batched call where it can.
+
+def dftMagnitudesMatrix(signals, n):
+
+  if not isSmooth(n):
+    return array([dftMagnitudes(d, n) for d in signals])
+
+  x = zeros((len(signals), n))
+  for k in range(0, len(signals)):
+    l = min(len(signals[k]), n)
+    x[k, :l] = signals[k][:l]
+
+  return abs(rfft(x, n, axis=1))
+
+# This function returns the matrix of the DFT similarities of every pair of a list of
+# signals, all compared with length n DFTs. The distances come out of one matrix
+# product, |a - b|^2 = |a|^2 + |b|^2 - 2 a.b with the Parseval weights applied.
+# Takes a (signals, n) tuple so that it can be mapped over a process pool.
+
+def similarityBlock(args):
+
+  signals, n = args
+
+  m = dftMagnitudesMatrix(signals, n)
+  mw = m*parsevalWeights(n)
+  sq = (mw*m).sum(axis=1)
 
-  if len(d1) != len(d2):
+  d2 = sq[:, newaxis] + sq[newaxis, :] - 2*dot(mw, m.T)
 
-    # Now calculate the DFT of the sequences.
+  # Rounding can take the distance of near identical spectra below zero.
 
-    d1_dft = calculateDFT(d1)
-    d2_dft = calculateDFT(d2)
+  return 1/(1 + sqrt(maximum(d2, 0)))
 
-    # Now calculate the inverse N point IDFT of both the sequences.
+# This function calculates the N x N matrix of DFT similarities of N tag encoded
+# signals, which need to be encoded with the same TagVocabulary. It gives the same
+# scores as calling dftSimilarity on every pair, but the pairs are grouped by the
+# length of the DFT they need, see dftSpectrumLength, and each group is done in one
+# vectorized pass, over a pool of processes if processes is more than 1.
 
-    d1_idft = calculateIDFT(d1_dft)
-    d2_idft = calculateIDFT(d2_dft)
+def dftSimilarityMatrix(signals, processes=None):
 
-    M = (len(d1) + len(d2)) - 1 # Calculate the minimum length
-    d1zp = zeroPad(d1_idft, M)
-    d2zp = zeroPad(d2_idft, M)
+  N = len(signals)
+  similarities = identity(N)
 
-    # Use FFT to calculate DFT, its fast.
+  # Group the pairs by DFT length.
 
-    d1_dft = fft(array(d1zp))
-    d2_dft = fft(array(d2zp))
+  pairs = {}
+  for i in range(0, N):
+    for j in range(i + 1, N):
+      n = dftSpectrumLength(len(signals[i]), len(signals[j]))
+      if n > 0:
+        pairs.setdefault(n, []).append((i, j))
+      else:
+        similarities[i, j] = similarities[j, i] = 1.0
 
+  tasks = []
+  for n in pairs:
+    indices = sorted(set([i for i, j in pairs[n]] + [j for i, j in pairs[n]]))
+    tasks.append((n, indices))
+
+  jobs = [([signals[k] for k in indices], n) for n, indices in tasks]
+
+  if processes is not None and processes > 1 and len(jobs) > 1:
+    pool = multiprocessing.Pool(processes)
+    try:
+      blocks = pool.map(similarityBlock, jobs)
+    finally:
+      pool.close()
+      pool.join()
   else:
+    blocks = map(similarityBlock, jobs)
 
-    # Now calculate the DFT of the sequences.
+  # Pick the scores of the pairs each group was done for.
 
-    d1_dft = calculateDFT(d1)
-    d2_dft = calculateDFT(d2)
+  for (n, indices), block in zip(tasks, blocks):
+    position = dict([(k, p) for p, k in enumerate(indices)])
+    for i, j in pairs[n]:
+      similarities[i, j] = similarities[j, i] = block[position[i], position[j]]
 
-  # DFT distance calculation based on Parsevals Theorem
+  return similarities
 
-  dftsum = 0.0
-  for l in range(0, len(d1_dft)):
-    s = (abs(d1_dft[l]) - abs(d2_dft[l]))**2
-    dftsum = dftsum + s
+# This function returns the mean and the standard deviation of the similarities of
+# the distinct pairs in a similarity matrix, as thresholds for classification.
 
-  distance = math.sqrt(dftsum)
+def similarityThresholds(similarities):
 
-  # Similarity measure calculation
+  scores = similarities[triu_indices(len(similarities), 1)]
+
+  if len(scores) == 0:
+    return 1.0, 0.0
+
+  return scores.mean(), scores.std()
+
+# This function is the batched version of calculateThresholdDftDistanceScore. The
+# sample pages are encoded once with the vocabulary, a new one seeded with their tags
+# in sorted order if none is given, and their similarity matrix is calculated with
+# dftSimilarityMatrix. Returns the matrix, the mean and the standard deviation.
+
+def calculateSimilarityMatrix(samplePages, vocabulary=None, processes=None):
+
+  if vocabulary is None:
+    vocabulary = TagVocabulary(sorted(getUniqueTagSet([], [t for rt in samplePages for t in rt])))
+
+  signals = [vocabulary.encode(rt) for rt in samplePages]
+  similarities = dftSimilarityMatrix(signals, processes)
+  mean, std = similarityThresholds(similarities)
+
+  return similarities, mean, std
+
+# This function compiles the CSS rules of a website into XPath expressions, once for
+# all the pages. The rules are translated the way pyquery does, jQuery extensions
+# such as :first included, so a compiled rule selects what pq(page)(rule) would.
+
+def compileContentRules(rules):
+
+  translator = JQueryTranslator(xhtml=False)
+
+  return [etree.XPath(translator.css_to_xpath(rule.replace('[@', '['), 'descendant-or-self::')) for rule in rules]
+
+# This function applies the compiled content rules to a page. The page is parsed once
+# for all the rules, and every rule is evaluated against the same tree. Returns the
+# text of what every rule selects, as pq(page)(rule).text() does.
+
+def extractFields(content, compiledRules):
+
+  roots = pq(content)
+
+  fields = []
+
+  for rule in compiledRules:
+    elements = []
+    for root in roots:
+      elements.extend(rule(root))
+    fields.append(pq(elements).text())
+
+  return fields
+
+# The compiled content rules of an extraction worker process, compiled once in every
+# worker by initExtractionWorker, as compiled rules cannot be pickled, and the file
+# the worker logs the pages it cannot extract to.
+
+workerRules = None
+workerErrorLog = None
+
+def initExtractionWorker(rules, errorLog=None):
+
+  global workerRules
+  global workerErrorLog
+
+  workerRules = compileContentRules(rules)
+  workerErrorLog = errorLog
+
+# This function extracts the record of one page with the rules of the worker. The page
+# is a (key, content) tuple, the record is the key followed by the fields. A page the
+# rules cannot be applied to is logged and None is returned, so that one bad page
+# costs its own record only.
+
+def extractPage(page):
+
+  key, content = page
+
+  try:
+    return [key] + extractFields(content, workerRules)
+  except Exception, e:
+    if workerErrorLog is not None:
+      KastGenericFunctionsLib.logException('Extraction failed for ' + str(key) + ': ' + repr(e) + ' - ' + str(time.time()), workerErrorLog)
+    return None
+
+# This function extracts the records of (key, content) pages, e.g. the items of a page
+# store, and yields them as they are done, in the order of the pages if ordered is
+# True. The pages are sharded over a pool of processes, and only a batch of them is
+# ever held in memory, see KastGenericFunctionsLib.poolMap, so the records can be
+# streamed straight to KastGenericFunctionsLib.writeToDisk. The pages which could
+# not be extracted are skipped, and logged to errorLog if one is given.
+
+def extractPages(rules, pages, processes=None, chunksize=16, ordered=False, errorLog=None):
+
+  for record in KastGenericFunctionsLib.poolMap(extractPage, pages, processes, initExtractionWorker, (rules, errorLog), chunksize, ordered):
+    if record is not None:
+      yield record
+
+# The namespace of all the data in our KB/DB.
+
+KASTNAMESPACE = 'http://www.kast.com/data/'
+
+# The characters left as they are in the IRIs made from extracted values, those URIs
+# may have, all others are percent encoded.
+
+IRISAFECHARACTERS = "/:@!$&'()*+,;=-._~?#[]%"
+
+# This function parses a line of a content log, as written by
+# KastGenericFunctionsLib.writeToDisk, back into the record, a list of unicode strings.
+
+def parseRecord(line):
+
+  record = ast.literal_eval('[' + line.rstrip('\r\n') + ']')
+
+  return [field.decode('utf-8') if isinstance(field, str) else unicode(field) for field in record]
+
+# This function returns the global unique ID of a record, the md5 term hash rdflib
+# gives to the KAST URI of its key, the URL of the page.
+
+def recordGuid(key):
+
+  h = hashlib.md5((KASTNAMESPACE + key).encode('utf-8'))
+  h.update('U')
+
+  return KASTNAMESPACE + 'id/' + h.hexdigest()
+
+# This function escapes the non ASCII characters of a string the N-Triples way, as
+# \uXXXX or \UXXXXXXXX, and returns the ASCII string.
+
+def ntriplesEscapeUnicode(value):
+
+  escaped = []
+
+  for c in value:
+    n = ord(c)
+    if n < 0x80:
+      escaped.append(c)
+    elif n <= 0xFFFF:
+      escaped.append('\\u%04X' % n)
+    else:
+      escaped.append('\\U%08X' % n)
+
+  return ''.join(escaped)
+
+# This function formats an IRI as an N-Triples term.
+
+def ntriplesIRI(iri):
+
+  if isinstance(iri, unicode):
+    iri = iri.encode('utf-8')
+
+  return '<' + urllib.quote(iri, IRISAFECHARACTERS) + '>'
+
+# This function formats a string as an N-Triples plain literal.
+
+def ntriplesLiteral(value):
+
+  value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+
+  return '"' + ntriplesEscapeUnicode(value) + '"'
+
+# This function yields the triples of a record, as (subject, predicate, object)
+# N-Triples terms. The subject is the GUID of the record, and field p is the value
+# of predicate predList[p], as a KAST resource which has the field as its value:
+#
+#   <guid> <kast:predicate> <kast:value> .
+#   <kast:value> <kast:hasvalue> "value" .
+#
+# predList[0] names the key of the record, the URL of the page, which is not a triple.
+
+def recordTriples(record, predList):
+
+  guid = ntriplesIRI(recordGuid(record[0]))
+  hasValue = ntriplesIRI(KASTNAMESPACE + 'hasvalue')
+
+  for p in range(1, min(len(predList), len(record))):
+
+    obj = ntriplesIRI(KASTNAMESPACE + record[p])
+
+    yield guid, ntriplesIRI(KASTNAMESPACE + predList[p]), obj
+    yield obj, hasValue, ntriplesLiteral(record[p])
+
+# This function returns the digest of a set of triples, the same whatever order the
+# triples come in.
+
+def triplesDigest(triples):
+
+  h = hashlib.md5()
+
+  for triple in sorted(triples):
+    h.update('%s %s %s\n' % triple)
+
+  return h.hexdigest()
+
+# This class remembers the triples that were loaded into the triple store for every
+# record, keyed by GUID, along with their digest, so that the next load can tell the
+# records which changed from the ones which did not, and which triples of a changed
+# record have to go. Kept in a sqlite database. Every record seen by a load is
+# stamped with the run number, the ones left with an older stamp are stale.
+
+class LoadedRecordStore:
+
+  def __init__(self, filename):
+
+    self.db = sqlite3.connect(filename)
+    self.db.text_factory = str
+    self.db.execute('CREATE TABLE IF NOT EXISTS records (guid TEXT PRIMARY KEY, digest TEXT NOT NULL, triples TEXT NOT NULL, run INTEGER NOT NULL)')
+    self.db.commit()
+
+    self.run = self.db.execute('SELECT COALESCE(MAX(run), 0) FROM records').fetchone()[0] + 1
+
+  # Return (digest, triples) of the record loaded with the GUID, (None, []) for the
+  # ones never loaded.
+
+  def get(self, guid):
+
+    row = self.db.execute('SELECT digest, triples FROM records WHERE guid = ?', (guid,)).fetchone()
+    if row is None:
+      return None, []
+
+    return row[0], [tuple(line.split(' ', 2)) for line in row[1].split('\n')]
+
+  def put(self, guid, digest, triples):
+
+    self.db.execute('INSERT OR REPLACE INTO records (guid, digest, triples, run) VALUES (?, ?, ?, ?)',
+                    (guid, digest, '\n'.join(['%s %s %s' % triple for triple in triples]), self.run))
+
+  # Mark a record as seen by this load, unchanged.
+
+  def touch(self, guid):
+
+    self.db.execute('UPDATE records SET run = ? WHERE guid = ?', (self.run, guid))
+
+  # Return the GUIDs of the records this load did not see.
+
+  def stale(self):
+
+    return [row[0] for row in self.db.execute('SELECT guid FROM records WHERE run < ?', (self.run,))]
+
+  def delete(self, guid):
+
+    self.db.execute('DELETE FROM records WHERE guid = ?', (guid,))
+
+  def clear(self):
+
+    self.db.execute('DELETE FROM records')
+    self.db.commit()
+
+  def __len__(self):
+
+    return self.db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+  # Make the changes since the last commit stick, once the triple store has them.
+
+  def commit(self):
+
+    self.db.commit()
 
-  similarityMeasure = 1/(1 + distance)
+  # Close without committing, whatever did not make it to the triple store is forgotten.
 
-  return similarityMeasure
+  def close(self):
 
+    self.db.close()
@@ -0,0 +1,354 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This module holds the tests of the Kast modules. They need no network and no
+# AllegroGraphDB server, run them with py.test or as a script.
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import KastParsersLib
+import KastCrawlerLib
+import KastClassifierLib
+import crawler
+
+# This function tests that a query string with non ASCII characters, as lxml hands
+# them out in unicode, canonicalizes to the same URL as its percent encoded UTF-8
+# spelling.
+
+def test_canonicalizeURLUnicodeQuery():
+
+  expected = 'http://x.com/search?q=caf%C3%A9'
+
+  assert KastParsersLib.canonicalizeURL(u'http://X.com/search?q=caf\xe9') == expected
+  assert KastParsersLib.canonicalizeURL('http://x.com/search?q=caf%C3%A9') == expected
+  assert KastParsersLib.canonicalizeURL(u'http://x.com/caf\xe9?b=2&a=1#top') == 'http://x.com/caf%C3%A9?a=1&b=2'
+
+# This function tests that the query parameters are sorted by name only, and each
+# one is kept as it is spelled, since the canonical URL is the one fetched.
+
+def test_canonicalizeURLQuerySpelling():
+
+  assert KastParsersLib.canonicalizeURL('http://x.com/p?print') == 'http://x.com/p?print'
+  assert KastParsersLib.canonicalizeURL('http://x.com/p?b=2;c=3&a=1') == 'http://x.com/p?a=1&b=2;c=3'
+  assert KastParsersLib.canonicalizeURL('http://x.com/p?id=1&x=&id=0') == 'http://x.com/p?id=1&id=0&x='
+  assert KastParsersLib.canonicalizeURL('http://x.com/p?q=a+b&&r=%2F') == 'http://x.com/p?q=a+b&r=%2F'
+
+# This function tests that a link which cannot be canonicalized is logged and
+# skipped, and the other links on the page are kept.
+
+def test_convert2AbsoluteHyperlinksBadLink():
+
+  fd, errorLog = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    links = KastParsersLib.convert2AbsoluteHyperlinks([u'/search?q=caf\xe9', u'http://[x.com/', '/p/1'], 'http://x.com', errorLog=errorLog)
+    assert links == ['http://x.com/search?q=caf%C3%A9', 'http://x.com/p/1']
+    assert 'http://[x.com/' in open(errorLog).read()
+  finally:
+    os.remove(errorLog)
+
+# This function tests that the validators of a fetch are only kept once the page
+# is confirmed stored, under the URL it was fetched from after a redirect.
+
+def test_fetchMetadataStoreStaging():
+
+  fd, filename = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    metadata = KastParsersLib.FetchMetadataStore(filename)
+    metadata.stage('http://x.com/a', 'http://x.com/b', '"1"', None)
+    metadata.stage('http://x.com/c', 'http://x.com/c', '"2"', None)
+    metadata.confirm('http://x.com/a')
+    metadata.discard('http://x.com/c')
+    assert metadata.get('http://x.com/b') == ('"1"', None)
+    assert metadata.get('http://x.com/c') == (None, None)
+    metadata.close()
+  finally:
+    os.remove(filename)
+
+# This function tests that a sample page which cannot be fetched fails the training,
+# and leaves no model behind for later runs to pick up.
+
+def test_loadOrTrainModelFailedSample():
+
+  directory = tempfile.mkdtemp()
+  modelFile = directory + '/site.model'
+
+  try:
+    KastClassifierLib.loadOrTrainModel(['http://127.0.0.1:1/p/1'], modelFile, directory + '/')
+    assert False, 'SampleError expected'
+  except KastClassifierLib.SampleError, e:
+    assert e.urls == ['http://127.0.0.1:1/p/1']
+
+  assert not os.path.exists(modelFile)
+
+  os.rmdir(directory)
+
+# This function tests that a page the rules cannot be applied to is logged and
+# skipped, and the other pages are still extracted, with and without a pool.
+
+def test_extractPagesBadPage():
+
+  fd, errorLog = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    for processes in (1, 2):
+      pages = [('http://x.com/1', '<html><head><title>One</title></head></html>'), ('http://x.com/2', 12345), ('http://x.com/3', '<html><head><title>Three</title></head></html>')]
+      records = list(KastParsersLib.extractPages(['title'], pages, processes, ordered=True, errorLog=errorLog))
+      assert records == [['http://x.com/1', 'One'], ['http://x.com/3', 'Three']]
+    assert open(errorLog).read().count('http://x.com/2') == 2
+  finally:
+    os.remove(errorLog)
+
+# This function tests that the page store lists its URLs batch by batch, every URL
+# once, while pages are relabeled and added along the way.
+
+def test_pageStoreItemsBatched():
+
+  directory = tempfile.mkdtemp()
+
+  try:
+    pageStore = KastCrawlerLib.PageStore(directory + '/')
+    for i in range(25):
+      pageStore.put('http://x.com/%02d' % i, '<html>%d</html>' % i)
+
+    seen = []
+    for url in pageStore.urls('', batchSize=4):
+      seen.append(url)
+      pageStore.relabel(url, 'useless')
+      pageStore.put(url + '/new', '<html>new</html>', 'useless')
+
+    assert seen == ['http://x.com/%02d' % i for i in range(25)]
+    assert list(pageStore.urls('')) == []
+    assert len(list(pageStore.items('useless'))) == 50
+    pageStore.close()
+  finally:
+    shutil.rmtree(directory)
+
+# This function makes the HTML of a synthetic product page, or of a listing page, the
+# two kinds of pages the classifier has to tell apart.
+
+def samplePage(i, kind='product'):
+
+  r = random.Random(i)
+
+  if kind == 'product':
+    specs = ''.join(['<tr><td class="k">k%d</td><td>v</td></tr>' % j for j in range(r.randint(5, 15))])
+    return '<html><head><title>P%d</title></head><body><div id="hdr"><a href="/">home</a></div><div class="product"><h1>Item %d</h1><img src="/i.jpg" /><span class="price">$%d</span><table>%s</table></div></body></html>' % (i, i, i, specs)
+
+  items = ''.join(['<li><a href="/p/%d">p</a><span>x</span></li>' % j for j in range(r.randint(5, 30))])
+  return '<html><head><title>L</title></head><body><div id="hdr"><a href="/">home</a></div><ul class="grid">%s</ul><p>%d</p></body></html>' % (items, i)
+
+# This function tests that classifying pages over a pool of processes gives the same
+# verdict for every page as classifying them one by one, for a model with a cascade
+# and for a template index.
+
+def test_classifyPagesMatchesSerial():
+
+  products = [KastParsersLib.content2TagSignal(samplePage(i)) for i in range(10)]
+  listings = [KastParsersLib.content2TagSignal(samplePage(i, 'listing')) for i in range(10)]
+
+  model = KastClassifierLib.SpectralModel(['p%d' % i for i in range(10)], products)
+  model.cascade = KastClassifierLib.CascadeFilter(model)
+
+  index = KastClassifierLib.TemplateIndex({'sample' : ['p%d' % i for i in range(10)], 'listing' : ['l%d' % i for i in range(10)]},
+                                          {'sample' : products, 'listing' : listings}, ['sample'])
+
+  pages = [('p%d' % i, samplePage(100 + i)) for i in range(30)] + [('l%d' % i, samplePage(100 + i, 'listing')) for i in range(30)]
+
+  for classifier in (model, index):
+
+    serial = sorted([(key,) + tuple(classifier.verdict(KastParsersLib.content2TagSignal(content))) for key, content in pages])
+    pooled = sorted(KastClassifierLib.classifyPages(classifier, pages, 2, chunksize=4))
+
+    assert pooled == serial
+    assert len(set([interesting for key, score, interesting in serial])) == 2
+
+# This function tests that the share of the pages a cascade rejects is measured on
+# the pages given, whatever the cascade saw before.
+
+def test_evaluateCascadeRepeated():
+
+  products = [KastParsersLib.content2TagSignal(samplePage(i)) for i in range(10)]
+  model = KastClassifierLib.SpectralModel(['p%d' % i for i in range(10)], products)
+  cascade = KastClassifierLib.CascadeFilter(model)
+
+  pages = [KastParsersLib.content2TagSignal(samplePage(100 + i)) for i in range(20)]
+  pages = pages + [KastParsersLib.content2TagSignal('<html><body>%s</body></html>' % ('<p>x</p>' * (50 + i))) for i in range(20)]
+
+  first = KastClassifierLib.evaluateCascade(model, cascade, pages)
+  assert first['rejected'] > 0
+  for i in range(3):
+    assert KastClassifierLib.evaluateCascade(model, cascade, pages)['rejected'] == first['rejected']
+
+# This function tests that a template index labels a page like none of its templates,
+# a login form, as unknown and not of interest, while the pages of its templates are
+# never labeled unknown.
+
+def test_templateIndexRejectsUnknownPages():
+
+  products = [KastParsersLib.content2TagSignal(samplePage(i)) for i in range(10)]
+  listings = [KastParsersLib.content2TagSignal(samplePage(i, 'listing')) for i in range(10)]
+
+  index = KastClassifierLib.TemplateIndex({'sample' : ['p%d' % i for i in range(10)], 'listing' : ['l%d' % i for i in range(10)]},
+                                          {'sample' : products, 'listing' : listings}, ['sample'])
+
+  login = '<html><head><title>Login</title><script src="/a.js"></script></head><body><form action="/login"><label>user</label><input name="u"/><label>password</label><input name="p"/><input type="submit"/></form></body></html>'
+
+  assert index.verdict(KastParsersLib.content2TagSignal(login)) == (KastClassifierLib.TEMPLATEUNKNOWN, False)
+
+  for i in range(100, 120):
+    for kind in ('product', 'listing'):
+      assert index.verdict(KastParsersLib.content2TagSignal(samplePage(i, kind)))[0] != KastClassifierLib.TEMPLATEUNKNOWN
+
+# This class serves a test site on the loopback interface, every path maps to a
+# (status, headers, body) tuple. A request carrying the ETag of its page gets a 304,
+# and every request is logged as (path, If-None-Match).
+
+class SiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+  routes = {}
+  hits = []
+
+  def log_message(self, *args):
+
+    pass
+
+  def do_GET(self):
+
+    self.hits.append((self.path, self.headers.get('If-None-Match')))
+    status, headers, body = self.routes.get(self.path, (404, {}, ''))
+
+    if headers.get('ETag') is not None and headers.get('ETag') == self.headers.get('If-None-Match'):
+      status, body = 304, ''
+
+    self.send_response(status)
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+class Site(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+# This function starts a test site serving the given routes, returns the server
+# and its base URL.
+
+def startSite(routes):
+
+  SiteHandler.routes = routes
+  SiteHandler.hits = []
+
+  server = Site(('127.0.0.1', 0), SiteHandler)
+  t = threading.Thread(target=server.serve_forever)
+  t.setDaemon(True)
+  t.start()
+
+  return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+# This function crawls a test site from its root, with the page store, the fetch
+# metadata and the logs of the crawler in directory. Returns False if the crawl did
+# not finish within timeout seconds.
+
+def crawlSite(base, directory, timeout=30):
+
+  crawler.sitename = 'site'
+  crawler.BASELOGDIR = directory + '/'
+  crawler.BASEHTTPCACHEDIR = directory + '/'
+  crawler.errorLog = directory + '/site.error'
+  crawler.includePatterns = []
+  crawler.excludePatterns = []
+  crawler.nearDuplicates = None
+  crawler.frontier = KastCrawlerLib.UrlFrontier([base + '/'])
+
+  # The page store is used from the thread it is opened in only.
+
+  def run():
+    crawler.pageStore = KastCrawlerLib.PageStore(directory + '/')
+    try:
+      crawler.crawl(base, 2, 0, True)
+    finally:
+      crawler.pageStore.close()
+
+  t = threading.Thread(target=run)
+  t.setDaemon(True)
+  t.start()
+  t.join(timeout)
+
+  return not t.isAlive()
+
+# This function tests that a new URL redirecting to a page of the last crawl, which
+# gets a 304 since the validators of the redirect target are sent along, is fetched
+# once more without validators and stored, instead of being refetched forever.
+
+def test_crawlRedirectToCrawledPage():
+
+  directory = tempfile.mkdtemp()
+  page = '<html><body><p>b</p></body></html>'
+
+  try:
+    server, base = startSite({'/' : (200, {}, '<html><body><a href="/b">b</a></body></html>'),
+                              '/b' : (200, {'ETag' : '"b"'}, page)})
+    assert crawlSite(base, directory)
+
+    SiteHandler.routes['/'] = (200, {}, '<html><body><a href="/a">a</a><a href="/b">b</a></body></html>')
+    SiteHandler.routes['/a'] = (301, {'Location' : base + '/b'}, '')
+    SiteHandler.hits = []
+    assert crawlSite(base, directory)
+    server.shutdown()
+
+    assert SiteHandler.hits.count(('/a', None)) == 2
+    assert SiteHandler.hits.count(('/b', '"b"')) == 2
+    assert SiteHandler.hits.count(('/b', None)) == 1
+
+    pageStore = KastCrawlerLib.PageStore(directory + '/')
+    assert pageStore.get(base + '/a') == page
+    pageStore.close()
+  finally:
+    shutil.rmtree(directory)
+
+# This function tests that a page which cannot be fetched is logged and skipped, not
+# stored, and the crawl goes on with the other pages.
+
+def test_crawlFailedFetch():
+
+  directory = tempfile.mkdtemp()
+  page = '<html><body><p>b</p></body></html>'
+
+  try:
+    server, base = startSite({'/' : (200, {}, '<html><body><a href="/missing">a</a><a href="/b">b</a></body></html>'),
+                              '/b' : (200, {}, page)})
+    assert crawlSite(base, directory)
+    server.shutdown()
+
+    pageStore = KastCrawlerLib.PageStore(directory + '/')
+    assert pageStore.get(base + '/b') == page
+    assert base + '/missing' not in pageStore
+    pageStore.close()
+
+    assert base + '/missing' in open(directory + '/site.error').read()
+  finally:
+    shutil.rmtree(directory)
+
+# Run every test of this module.
+
+if __name__ == '__main__':
+
+  tests = sorted([name for name in dir() if name.startswith('test_')])
+
+  for name in tests:
+    globals()[name]()
+    print name, 'ok'
@@ -35,6 +35,7 @@ import os # Provides OS system calls interface.
 import sys # Provides general system calls interface
 import time # Provides time operations
 import random # Provides random number generation
+import multiprocessing # Provides the CPU count
 import urllib2 # HTTP client library
 import string # String operations module
 import pdb # Debug Module
@@ -83,6 +84,8 @@ BASE_URI = 'http://www.kast.com/data'
 
 import KastParsersLib # Custom parsing module with specific parsing functions.
 import KastGenericFunctionsLib # Custom module for handy generic functions.
+import KastCrawlerLib # Crawl engine: politeness scheduler and concurrent fetcher.
+import KastClassifierLib # Page classifier: the trained model of a website.
 
 # Global constants
 
@@ -91,6 +94,51 @@ BASELOCKFILEDIR = '/kast/lock/'
 BASEFILESTORAGEDIR = '/kast/'
 BASEERRORLOGDIR = '/kast/errorlog/'
 BASECONTENTDIR = '/kast/content/'
+BASEFRONTIERDIR = '/kast/frontier/'
+BASEHTTPCACHEDIR = '/kast/httpcache/'
+BASEMODELDIR = '/kast/model/'
+BASESAMPLEDIR = '/kast/samples/'
+
+# Crawl engine tuning, the worker count and delay can be overridden per site in
+# the config file with the 'CrawlWorkers' and 'CrawlDelay' keys.
+
+CRAWLWORKERS = 8 # Number of concurrent fetches in flight.
+CRAWLDELAY = 1.0 # Seconds between two requests to the same host.
+CRAWLBURST = 1 # Number of requests a host may receive back to back.
+CRAWLSTATSINTERVAL = 60 # Seconds between two lines in the crawl stats log.
+CRAWLCHECKPOINTEVERY = 1000 # Frontier updates between two checkpoints to disk.
+CONDITIONALGET = True # Skip pages not modified since the last crawl, 'ConditionalGet' key.
+CLASSIFYPROCESSES = multiprocessing.cpu_count() # Classifier processes, 'ClassifyProcesses' key.
+EXTRACTPROCESSES = multiprocessing.cpu_count() # Extraction processes, 'ExtractProcesses' key.
+EXTRACTORDERED = False # Write the records in page store order, 'ExtractOrdered' key.
+NTRIPLESGZIP = False # Gzip the N-Triples file, 'NTriplesGzip' key.
+LOADDIRECT = True # Load the records into the store without an N-Triples file, 'LoadDirect' key.
+LOADBATCHSIZE = 10000 # Quads per request of a direct load, 'LoadBatchSize' key.
+LOADQUEUEDEPTH = 2 # Batches made ahead of every upload in a direct load.
+LOADWORKERS = 4 # Concurrent uploads of a direct load, 'LoadWorkers' key.
+LOADINCREMENTAL = False # Load only what changed since the last load, 'LoadIncremental' key,
+                        # into one named graph per record, see upsertContentLog2db.
+CLASSIFYINLINE = True # Classify pages as they are crawled, not after, 'ClassifyInline' key.
+KEEPUSELESSPAGES = True # Store the pages not of interest, labeled useless, 'KeepUselessPages' key.
+CLASSIFYCASCADE = True # Prefilter pages before scoring them, 'ClassifyCascade' key, the
+                       # tolerances are the 'CascadeLengthRatio', 'CascadeHistogramSlack',
+                       # 'CascadeSpectrumSlack' and 'CascadeTopK' keys, see KastClassifierLib.
+INTERESTINGTEMPLATES = ['sample'] # The templates of interest, 'InterestingTemplates' key.
+NEARDUPLICATES = False # Flag the near duplicates of crawled pages, 'NearDuplicates' key, with
+                       # at most 'NearDuplicateDistance' bits of SimHash difference and at
+                       # least 'NearDuplicateSimilarity' shingles in common with the stored
+                       # copy of the match. Off by default, a page flagged is not extracted.
+SKIPDUPLICATELINKS = False # Do not follow the links of near duplicates, 'SkipDuplicateLinks' key.
+
+# How the frontier is kept, overridden per site with the 'FrontierMode' key:
+#
+# 'disk'    - in a sqlite database, bounded memory and resumable after a crash.
+# 'memory'  - in memory, every seen URL in a hash set.
+# 'compact' - in memory, seen URLs as 64-bit fingerprints in a FingerprintSet,
+#             for tens of millions of URLs. 'ExpectedUrls' sizes the table.
+
+FRONTIERMODE = 'disk'
+EXPECTEDURLS = 1 << 20
 
 # List of absolute filenames that need to be globally accessible.
 
@@ -98,19 +146,40 @@ lockFile = ''
 errorLog = ''
 sitename = ''
 contentLogFile = ''
+nearDuplicatesFile = ''
+loadedRecordsFile = ''
 
-# Global list of absolute URLs of a particular website that has to be crawled yet.
-
-unseenUrlList = []
+# Global URL frontier of a particular website, the URLs that have to be crawled yet
+# along with every URL seen so far.
 
-# Global list of absolute URLs of a particular website that has been crawled.
-
-visitedUrlList = []
+frontier = KastCrawlerLib.UrlFrontier()
 
 # A global variable to make sure lock files are not generated in testmode.
 
 mode = 't'
 
+# Compiled URL include/exclude patterns, from the 'IncludePatterns' and
+# 'ExcludePatterns' keys of the config file. Links are enqueued only if they match
+# one of the include patterns, if any are given, and none of the exclude patterns.
+
+includePatterns = []
+excludePatterns = []
+
+# The store of the crawled pages, see KastCrawlerLib.PageStore.
+
+pageStore = None
+
+# The SimHashes of the pages in the store, for near-duplicate detection, None if it is
+# off. See KastCrawlerLib.SimHashIndex. A SimHash match is a near duplicate only if
+# the shingles of the two pages are at least nearDuplicateSimilarity alike.
+
+nearDuplicates = None
+nearDuplicateSimilarity = KastCrawlerLib.NEARDUPLICATESIMILARITY
+
+# Counters of the running crawl, pages/sec, in flight requests etc.
+
+fetchStats = None
+
 # This function gets returns a connection object with a triple store created
 # or renewed.
 
@@ -135,253 +204,400 @@ def getServerConnection(accessMode):
   # Return the connection object.
   return connection
 
-# This function downloads the pages in a BFS manner.
-# We may need to parallize this script.
+# This function returns the page store label for the pages which are not of interest.
+# With a template index the score is the template of the page, and the pages of
+# every template are kept apart.
 
-def crawl(targetWebsite):
+def uselessPagesLabel(model, score):
 
-  global sitename
-  global errorLog
-  global unseenUrlList
-  global visitedUrlList
-  global BASEFILESTORAGEDIR
+  label = 'useless'
 
-  # Now start the crawling rountine.
+  if isinstance(model, KastClassifierLib.TemplateIndex):
+    label = 'useless/' + score
 
-  while (1):
+  return label
 
-    if unseenUrlList != []:
+# This function tells if a page is a near duplicate of one of the pages whose SimHashes
+# match its own, by comparing it with their stored copies, see
+# KastCrawlerLib.shingleSimilarity. A match with no stored copy does not count.
 
-      # Choose a page randomly
+def isNearDuplicate(r, candidates):
 
-      page = random.choice(unseenUrlList)
+  global pageStore
+  global nearDuplicateSimilarity
 
-      # Fetch the content.
+  for url in candidates:
+    other = pageStore.get(url)
+    if other is not None and KastCrawlerLib.shingleSimilarity(r, other) >= nearDuplicateSimilarity:
+      return True
 
-      r = KastParsersLib.fetchURL(page)
+  return False
 
-      # Clean the content.
+# This function processes one fetched page: it stores the content and queues up
+# the hyperlinks found on it. Returns True if the page was stored.
 
-      r = KastParsersLib.cleanHtml(r)
+def processPage(page, r, targetWebsite, model=None, keepUselessPages=True, skipDuplicateLinks=False):
 
-      # Write the content to a file, in the designated folder.
+  global pageStore
+  global nearDuplicates
 
-      filename = KastGenericFunctionsLib.extractWebSiteName(page) + '-' + str(round(time.time(), 2))
-      # Replace all '/' with [kastSlash]
-      filename = string.replace(filename, '/', '[kastSlash]')
-      f = gzip.open(BASEFILESTORAGEDIR + filename + '.gz', 'wb')
-      f.write(r)
-      f.close()
+  # Clean the content.
 
-      # Convert to DOM and apply the CSS rule engine
+  r = KastParsersLib.cleanHtml(r)
 
-      d = pq(r)
-      ele_a = d('a')
+  # A page which is a near duplicate of a page crawled before, the same product under
+  # another URL, is stored with the duplicate label, so that it is neither classified
+  # nor extracted, or not stored at all.
 
-      # Extract the hyperlinks
+  duplicate = False
 
-      links_a = KastParsersLib.extractHyperlinks(ele_a)
+  if nearDuplicates is not None:
+    h = KastCrawlerLib.simHash(r)
+    duplicate = isNearDuplicate(r, nearDuplicates.candidates(h, page))
+    if not duplicate:
+      nearDuplicates.add(h, page)
 
-      # Convert to absolute links.
+  # With a model the page is classified right here, from memory. Pages which are not
+  # of interest are stored with the useless label, or not stored at all.
 
-      unseenUrlListTmp = KastParsersLib.convert2AbsoluteHyperlinks(links_a, targetWebsite)
+  label = ''
 
-      # Now check how many of these links exist in Visited URL list.
+  if duplicate:
+    label = 'duplicate'
+    if not keepUselessPages:
+      label = None
+  elif model is not None:
+    score, interesting = model.verdict(KastParsersLib.content2TagSignal(r))
+    if not interesting:
+      label = uselessPagesLabel(model, score)
+      if not keepUselessPages:
+        label = None
 
-      for link in unseenUrlListTmp:
-        if not visitedUrlList.__contains__(link):
-          unseenUrlList.append(link)
+  # Store the content, under the URL of the page.
 
-      # Now append this page processed to visited URLs list.
+  if label is not None:
+    pageStore.put(page, r, label)
 
-      visitedUrlList.append(page)
+  # The links of a duplicate are most likely those of the page it duplicates.
 
-      # Now remove the same link from unseenUrlList.
+  if not (duplicate and skipDuplicateLinks):
+    processLinks(page, r, targetWebsite)
 
-      unseenUrlList.remove(page)
+  return label is not None
 
-      # Condition to end the crawl.
+# This function queues up the hyperlinks found on a page.
 
-      # Debug ON, turn off in production.
+def processLinks(page, r, targetWebsite):
 
-      pdb.set_trace()
+  global errorLog
+  global frontier
+  global includePatterns
+  global excludePatterns
 
-      if unseenUrlList == []:
-        return
+  # Convert to DOM and apply the CSS rule engine
 
-# This function is our classifier, it applies the DFT distance algorithm and
-# preserves those html pages which are of interest. It moves the files which
-# are not of interest to a folder.
+  d = pq(r)
+  ele_a = d('a')
 
-def classify(htmlSeries, sm):
+  # Extract the hyperlinks
 
-  global BASEFILESTORAGEDIR
+  links_a = KastParsersLib.extractHyperlinks(ele_a)
 
-  # Make the useless folder page.
+  # Convert to canonical absolute links, relative to this page, keeping only the
+  # ones on the target website that pass the include/exclude patterns.
 
-  uselessPagesFolder = chkmkFolderStructure(BASEFILESTORAGEDIR + '/useless/')
+  unseenUrlListTmp = KastParsersLib.convert2AbsoluteHyperlinks(links_a, targetWebsite, page, includePatterns, excludePatterns, errorLog)
 
-  # List all the files, in the folder.
+  # Now queue up the links, the frontier drops the ones already seen.
 
-  listOfFiles = os.listdir(BASEFILESTORAGEDIR)
-  listOfFiles = [BASEFILESTORAGEDIR + p for p in listOfFiles]
+  for link in unseenUrlListTmp:
+    frontier.add(link)
 
-  # Now start the loop and process every file
+# This function downloads the pages in a BFS manner. The fetching is done by a pool
+# of CRAWLWORKERS threads, which keeps that many requests in flight, while a per-host
+# token bucket keeps us to one request every CRAWLDELAY seconds per host. Given the
+# trained model of the website every page is classified as soon as it is fetched,
+# see processPage.
 
-  for l in range(0, len(listOfFiles)):
+def crawl(targetWebsite, workers=None, delay=None, conditionalGet=None, model=None, keepUselessPages=None, skipDuplicateLinks=None):
 
-    # Choose a file randomly.
+  global sitename
+  global errorLog
+  global frontier
+  global fetchStats
+  global nearDuplicates
+  global nearDuplicatesFile
+  global BASELOGDIR
+  global BASEHTTPCACHEDIR
 
-    page = random.choice(listOfFiles)
+  if workers is None:
+    workers = CRAWLWORKERS
+  if delay is None:
+    delay = CRAWLDELAY
+  if conditionalGet is None:
+    conditionalGet = CONDITIONALGET
+  if keepUselessPages is None:
+    keepUselessPages = KEEPUSELESSPAGES
+  if skipDuplicateLinks is None:
+    skipDuplicateLinks = SKIPDUPLICATELINKS
 
-    # Extract the content of the file
+  # Pages are fetched over persistent connections and, on a recrawl, with
+  # conditional GETs based on the ETag/Last-Modified of the last crawl.
 
-    c = gzip.open(page, 'rb')
-    contents = c.read()
-    c.close()
+  connections = KastParsersLib.ConnectionPool()
+  metadata = None
+  if conditionalGet:
+    metadata = KastParsersLib.FetchMetadataStore(BASEHTTPCACHEDIR + sitename + '.http')
 
-    # Write to a tmp file.
+  def fetch(url, conditional=True):
+    return KastParsersLib.fetchURLPooled(url, connections, metadata, conditional)
 
-    tmpFilename = '/tmp/' + page.split('/')[-1]
-    f = file(tmpFilename, 'w')
-    f.write(contents)
-    f.close()
+  # Start the fetch engine.
 
-    # Generate html series of this file, tphs --> testPageHtmlSeries
+  scheduler = KastCrawlerLib.HostScheduler(delay, CRAWLBURST)
+  fetchStats = KastCrawlerLib.FetchStats()
+  pool = KastCrawlerLib.FetchPool(workers, scheduler, fetchStats, fetch)
 
-    tphsUrl = 'file://' + tmpFilename
-    tphs = KastParsersLib.html2TagSignal(tphsUrl)
+  statsLog = BASELOGDIR + sitename + '.stats.log'
+  lastStatsTime = time.time()
 
-    # dftDistance scoreboard
+  # The pages fetched again without validators, see below.
 
-    dftDistanceScoreboard = []
+  refetched = set()
 
-    for d in htmlSeries:
+  # Now start the crawling rountine.
 
-      # Now calculate the score and append them to an array.
+  try:
 
-      dftDistanceScoreboard.append(KastParsersLib.dftDistance(tphs, d))
+    while (1):
 
-    # Now calculate average.
+      # Keep the workers busy, hand out pages while there is room.
 
-    s = KastGenericFunctionsLib.calcAvg(dftDistanceScoreboard)
+      while len(frontier) > 0 and pool.hasCapacity():
 
-    # Score is less than mean similarity measure, move it to the useless folder.
+        # Take the next page off the frontier, it stays in the seen set so that no
+        # other worker is handed the same page.
 
-    if s < sm:
-      os.system(page, uselessPagesFolder)
+        page = frontier.pop()
+        pool.submit(page)
 
-# This is the function which will extract the content from the pages of interest
-# and will log it into a file.
+      # Condition to end the crawl.
 
-def extractContent(rules):
+      if pool.pending == 0:
+        return
 
-  global contentLogFile
+      # Wait for a page to come back and process it. Its validators are kept for
+      # the next crawl only if it made it to the page store.
 
-  # Now obtain a list of all the files from the content folder.
+      page, r = pool.next()
 
-  listOfFiles = os.listdir(BASEFILESTORAGEDIR)
-  listOfFiles = [BASEFILESTORAGEDIR + l for l in listOfFiles]
+      # A page which could not be fetched, counted as an error by fetchStats, is
+      # neither stored nor parsed.
 
-  records = []
+      if r == '':
+        KastGenericFunctionsLib.logException('Page could not be fetched: ' + page + ' - ' + str(time.time()), errorLog)
+        if metadata is not None:
+          metadata.discard(page)
+        refetched.discard(page)
+        frontier.done(page)
+        continue
 
-  # Now loop through the files and apply the rules
+      if r is not None:
+        stored = processPage(page, r, targetWebsite, model, keepUselessPages, skipDuplicateLinks)
+        if metadata is not None:
+          if stored:
+            metadata.confirm(page)
+          else:
+            metadata.discard(page)
 
-  for f in listOfFiles:
+      else:
 
-    # Read the gzipped file
+        # A page which was not modified since the last crawl is not stored again, but
+        # the pages it links to may be new, so its links are taken from the stored
+        # copy. Without one, say a new URL redirecting to a crawled page, the page is
+        # fetched afresh, with no validators for any URL of the redirect chain. A
+        # server answering that with a 304 too gets the page dropped.
 
-    g = gzip.open(f, 'rb')
-    c = g.read()
-    g.close()
+        r = pageStore.get(page)
+        if r is None:
+          if page not in refetched:
+            refetched.add(page)
+            pool.submit(page, conditional=False)
+            continue
+          KastGenericFunctionsLib.logException('Not modified without a stored copy: ' + page + ' - ' + str(time.time()), errorLog)
+          refetched.discard(page)
+          frontier.done(page)
+          continue
 
-    record = []
+        processLinks(page, r, targetWebsite)
 
-    # Replace [kastSlash] with '/' when we will store and process data.
+      refetched.discard(page)
+      frontier.done(page)
 
-    f = string.replace(f, '[kastSlash]', '/')
+      # Log the fetch counters every now and then.
 
-    # Append the name of the file, because it serves as value for product location
+      if time.time() - lastStatsTime >= CRAWLSTATSINTERVAL:
+        KastGenericFunctionsLib.logException(str(fetchStats) + ' - ' + str(time.time()), statsLog)
+        lastStatsTime = time.time()
 
-    record.append(f.split('/')[-1])
+  finally:
 
-    # Now apply the rules serially and extract content.
+    pool.close()
+    connections.close()
+    if metadata is not None:
+      metadata.close()
+    frontier.checkpoint()
+    pageStore.checkpoint()
+    if nearDuplicates is not None:
+      nearDuplicates.save(nearDuplicatesFile)
+    KastGenericFunctionsLib.logException(str(fetchStats) + ' - ' + str(time.time()), statsLog)
+    if getattr(model, 'cascade', None) is not None:
+      KastGenericFunctionsLib.logException('cascade ' + str(model.cascade) + ' - ' + str(time.time()), statsLog)
 
-    for r in rules:
+# This function is our classifier, it scores every page against the trained model
+# of the website and preserves those html pages which are of interest. It labels the
+# pages which are not of interest as useless in the page store. The pages are
+# classified by a pool of processes, CLASSIFYPROCESSES of them unless told otherwise.
 
-      # Get a jQuery type $ object for this html page.
+def classify(model, processes=None):
 
-      d = pq(c)
+  global pageStore
 
-      # Apply the CSS selector
+  if processes is None:
+    processes = CLASSIFYPROCESSES
 
-      ele = d(r)
+  # Now classify every page which is not labeled yet, as the verdicts come in label
+  # the pages which score less than the mean similarity measure as useless.
 
-      # Store the obtained text in an array.
+  for page, score, interesting in KastClassifierLib.classifyPages(model, pageStore.items(''), processes):
 
-      record.append(ele.text)
+    if not interesting:
+      pageStore.relabel(page, uselessPagesLabel(model, score))
 
-    # Now append the record to records.
+  pageStore.checkpoint()
 
-    records.append(record)
+# This is the function which will extract the content from the pages of interest
+# and will log it into a file. The pages are shared out over a pool of processes,
+# EXTRACTPROCESSES of them unless told otherwise, and every record is written to the
+# content log as soon as it comes back, in the order of the pages if ordered is True.
 
-  # Now write all the records to a designated content log file.
+def extractContent(rules, processes=None, ordered=None):
 
-  KastGenericFunctionsLib.writeToDisk(contentLogFile, records)
+  global errorLog
+  global contentLogFile
+  global pageStore
 
-# This function converts a log file full of data into N-Triples format.
+  if processes is None:
+    processes = EXTRACTPROCESSES
+  if ordered is None:
+    ordered = EXTRACTORDERED
 
-def table2RDFNTriplesConverter(logFile, predList):
+  # Every record is the URL of the page, because it serves as value for product
+  # location, followed by the text every rule selects on the page.
 
-  global sitename
+  records = KastParsersLib.extractPages(rules, pageStore.items(''), processes, ordered=ordered, errorLog=errorLog)
 
-  # Define a namespace, this is constant for all data in our KB/DB
+  # Now stream the records to a designated content log file.
 
-  KAST = Namespace('http://www.kast.com/data/')
+  KastGenericFunctionsLib.writeToDisk(contentLogFile, records)
 
-  # Define a ConjunctiveGraph, a normal graph also is sufficient but this
-  # kind of graph helps us in trivially merging various kinds of sub components.
+# This function yields the records of a content log, a line at a time. Malformed
+# lines are logged and skipped.
 
-  g = ConjunctiveGraph()
+def readContentLog(logFile):
 
-  # Now read the log file
+  global errorLog
 
   f = file(logFile, 'r')
-  records = f.readlines()
-  f.close()
 
-  # Now loop through all the records and also through predicate list
+  try:
 
-  for record in records:
+    for line in f:
 
-    # Define a guid which is the only unique primary key in our entire database.
+      if line.strip() == '':
+        continue
 
-    guid = 'http://www.kast.com/data/id/'
+      try:
+        record = KastParsersLib.parseRecord(line)
+      except (SyntaxError, ValueError), e:
+        KastGenericFunctionsLib.logException('Malformed record in ' + logFile + ': ' + line.strip() + ' - ' + str(time.time()), errorLog)
+        continue
 
-    # Now split to obtain the url from the record and hash it to obtain a global unique ID
+      yield record
 
-    guid = guid + KAST[record.split(',')[0]].md5_term_hash()
+  finally:
 
-    for p in range(1, len(predList)):
+    f.close()
 
-      # Generate the predicate
+# This function yields the triples of all the records of a content log, see
+# KastParsersLib.recordTriples.
 
-      pred = KAST[predList[p]]
-      dataItem = record.split(',')[p]
-      obj = KAST[dataItem]
+def contentLogTriples(logFile, predList):
 
-      # Now add the triples in the defined Conjunctive Graph.
+  for record in readContentLog(logFile):
+    for triple in KastParsersLib.recordTriples(record, predList):
+      yield triple
 
-      g.add((guid, pred, obj))
-      g.add((obj, KAST['hasvalue']), rdflib.Literal(dataItem))
+# This function logs the throughput of a conversion or load to the stats log.
 
-  # Now after adding all the triples, serialize it to N-Triples format.
+def logThroughput(what, count, start):
 
-  o = file(BASECONTENTDIR + sitename + '.nt', 'w')
-  o.write(g.serialize(format="nt"))
-  o.close()
+  global sitename
+
+  elapsed = time.time() - start
+  if elapsed > 0:
+    KastGenericFunctionsLib.logException('%s=%d seconds=%.2f %s/sec=%.0f - %s' % (what, count, elapsed, what, count/elapsed, time.time()), BASELOGDIR + sitename + '.stats.log')
+
+# This function converts a log file full of data into N-Triples format. The log is
+# read a record at a time and the triples of every record are written out as they
+# are made, through a buffered file, gzip compressed if compress is True, so the
+# memory used does not grow with the log. The throughput goes to the stats log.
+# Returns the name of the N-Triples file.
+
+def table2RDFNTriplesConverter(logFile, predList, compress=None):
+
+  global sitename
+
+  if compress is None:
+    compress = NTRIPLESGZIP
+
+  nTriplesFile = BASECONTENTDIR + sitename + '.nt'
+  if compress:
+    nTriplesFile = nTriplesFile + '.gz'
+
+  raw = file(nTriplesFile, 'wb', KastGenericFunctionsLib.WRITEBUFFERSIZE)
+  o = raw
+  if compress:
+    o = gzip.GzipFile(fileobj=raw, mode='wb')
+
+  triples = 0
+  start = time.time()
+
+  try:
+
+    for triple in contentLogTriples(logFile, predList):
+      o.write('%s %s %s .\n' % triple)
+      triples = triples + 1
+
+  finally:
+
+    o.close()
+    if compress:
+      raw.close()
+
+  logThroughput('ntriples', triples, start)
+
+  return nTriplesFile
+
+# This function throws away what the incremental loads remember of the triple store,
+# once a full load has replaced its content.
+
+def forgetLoadedRecords():
 
-  return BASECONTENTDIR + sitename + '.nt'
+  global loadedRecordsFile
+
+  if os.path.exists(loadedRecordsFile):
+    os.remove(loadedRecordsFile)
 
 # This function stores the data file into the AllegroGraphDB instance running on some
 # remote server.
@@ -395,6 +611,7 @@ def store2db(datafile):
   # Now load the data.
 
   connection.clear()
+  forgetLoadedRecords()
 
   # Now load the triples.
 
@@ -404,17 +621,184 @@ def store2db(datafile):
 
   connection.indexTriples(all=True)
 
+# This function loads a content log straight into the AllegroGraphDB instance, with
+# no N-Triples file in between. The triples of the records are sent as quads in the
+# default graph with RepositoryConnection.addTriplesParallel, split by subject across
+# workers concurrent uploads of batchSize quads a request. Every upload queues at
+# most LOADQUEUEDEPTH batches, so conversion and upload overlap while only a few
+# batches are held in memory. The throughput goes to the stats log.
+
+def loadContentLog2db(logFile, predList, batchSize=None, workers=None):
+
+  if batchSize is None:
+    batchSize = LOADBATCHSIZE
+
+  if workers is None:
+    workers = LOADWORKERS
+
+  # First get a connection object to our server, with an empty store.
+
+  connection = getServerConnection(Repository.RENEW)
+  connection.clear()
+  forgetLoadedRecords()
+
+  # Now load the quads, the terms are N-Triples already.
+
+  start = time.time()
+
+  quads = connection.addTriplesParallel(contentLogTriples(logFile, predList), ntriples=True, workers=workers, batchSize=batchSize, queueDepth=LOADQUEUEDEPTH)
+
+  logThroughput('quads', quads, start)
+
+  # Now index all the triples added.
+
+  connection.indexTriples(all=True)
+
+# This function loads a content log into the AllegroGraphDB instance incrementally,
+# into the store the earlier loads left, instead of a renewed one. The triples of
+# every record go into a named graph of its own, the GUID of the record, and a
+# LoadedRecordStore remembers what was loaded for every GUID. A record whose triples
+# have the same digest as last time is skipped, for a changed one only the quads it
+# lost are deleted and only the ones it gained are added, and the graphs of the
+# records no longer in the log are emptied. Deletions are sent batchSize quads a
+# request, then the additions of the batch over workers concurrent uploads with
+# RepositoryConnection.addTriplesParallel. The state is committed once a batch made
+# it to the store, and only the new triples are indexed at the end. If the store is
+# empty, or there is no state to go by, the store is cleared and loaded afresh.
+
+def upsertContentLog2db(logFile, predList, batchSize=None, workers=None):
+
+  global sitename
+  global loadedRecordsFile
+
+  if batchSize is None:
+    batchSize = LOADBATCHSIZE
+
+  if workers is None:
+    workers = LOADWORKERS
+
+  loaded = KastParsersLib.LoadedRecordStore(loadedRecordsFile)
+
+  try:
+
+    # First get a connection object to our server, creating the store if need be.
+
+    connection = getServerConnection(Repository.ACCESS)
+
+    if len(loaded) == 0 or connection.size() == 0:
+      connection.clear()
+      loaded.clear()
+
+    removals = []
+    additions = []
+    pending = set()
+    counts = {'added' : 0, 'changed' : 0, 'unchanged' : 0, 'removed' : 0, 'quads' : 0}
+    start = time.time()
+
+    # Send the pending deletions then additions, and commit the state.
+
+    def flush():
+
+      if removals:
+        connection.removeQuads(removals, ntriples=True)
+      if additions:
+        connection.addTriplesParallel(additions, ntriples=True, workers=workers, batchSize=batchSize, queueDepth=LOADQUEUEDEPTH)
+
+      loaded.commit()
+
+      counts['quads'] = counts['quads'] + len(removals) + len(additions)
+      del removals[:]
+      del additions[:]
+      pending.clear()
+
+    # Now diff every record against what was loaded for it.
+
+    for record in readContentLog(logFile):
+
+      guid = KastParsersLib.recordGuid(record[0])
+      triples = set(KastParsersLib.recordTriples(record, predList))
+      digest = KastParsersLib.triplesDigest(triples)
+
+      oldDigest, oldTriples = loaded.get(guid)
+
+      if digest == oldDigest:
+        loaded.touch(guid)
+        counts['unchanged'] = counts['unchanged'] + 1
+        continue
+
+      # The same record twice in a batch, the first one has to be in the store
+      # before the second one is diffed against it.
+
+      if guid in pending:
+        flush()
+        oldDigest, oldTriples = loaded.get(guid)
+
+      if oldDigest is None:
+        counts['added'] = counts['added'] + 1
+      else:
+        counts['changed'] = counts['changed'] + 1
+
+      context = KastParsersLib.ntriplesIRI(guid)
+      oldTriples = set(oldTriples)
+
+      removals.extend([triple + (context,) for triple in oldTriples - triples])
+      additions.extend([triple + (context,) for triple in triples - oldTriples])
+      loaded.put(guid, digest, triples)
+      pending.add(guid)
+
+      if len(removals) >= batchSize or len(additions) >= batchSize*workers:
+        flush()
+
+    # Now the records which are gone.
+
+    for guid in loaded.stale():
+
+      context = KastParsersLib.ntriplesIRI(guid)
+      removals.extend([triple + (context,) for triple in loaded.get(guid)[1]])
+      loaded.delete(guid)
+      counts['removed'] = counts['removed'] + 1
+
+      if len(removals) >= batchSize:
+        flush()
+
+    flush()
+
+    logThroughput('quads', counts['quads'], start)
+    KastGenericFunctionsLib.logException('records added=%(added)d changed=%(changed)d unchanged=%(unchanged)d removed=%(removed)d' % counts + ' - ' + str(time.time()), BASELOGDIR + sitename + '.stats.log')
+
+    # Now index the triples added, not the whole store.
+
+    connection.indexTriples(all=False)
+
+  finally:
+
+    loaded.close()
+
 # This function kickstarts our crawler program.
 
 def main(targetWebsite, configFile):
 
-  global unseenUrlList
+  global sitename
+  global lockFile
+  global errorLog
+  global frontier
+  global pageStore
+  global nearDuplicates
+  global nearDuplicateSimilarity
+  global includePatterns
+  global excludePatterns
   global BASELOGDIR
   global BASELOCKFILEDIR
   global BASEFILESTORAGEDIR
   global BASEERRORLOGDIR
   global BASECONTENTDIR
+  global BASEFRONTIERDIR
+  global BASEHTTPCACHEDIR
+  global BASEMODELDIR
+  global BASESAMPLEDIR
   global contentLogFile
+  global nearDuplicatesFile
+  global loadedRecordsFile
   global mode
 
   # Extract website name
@@ -428,25 +812,37 @@ def main(targetWebsite, configFile):
   BASEFILESTORAGEDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASEFILESTORAGEDIR + sitename + '/')
   BASEERRORLOGDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASEERRORLOGDIR)
   BASECONTENTDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASECONTENTDIR)
+  BASEFRONTIERDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASEFRONTIERDIR)
+  BASEHTTPCACHEDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASEHTTPCACHEDIR)
+  BASEMODELDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASEMODELDIR)
+  BASESAMPLEDIR = KastGenericFunctionsLib.chkmkFolderStructure(BASESAMPLEDIR + sitename + '/')
 
   # Now generate the task/target specific filenames.
 
   lockFile = BASELOCKFILEDIR + sitename + '.lock'
   errorLog = BASEERRORLOGDIR + sitename + '.error'
   contentLogFile = BASECONTENTDIR + sitename + '-' + str(round(time.time(), 2))
+  frontierFile = BASEFRONTIERDIR + sitename + '.frontier'
+  modelFile = BASEMODELDIR + sitename + '.model'
+  templateIndexFile = BASEMODELDIR + sitename + '.templates'
+  nearDuplicatesFile = BASEFILESTORAGEDIR + 'simhash.index'
+  loadedRecordsFile = BASECONTENTDIR + sitename + '.loaded'
 
-  # Now check if the lock file exists and proceed with crawling.
+  # Now check if the lock file exists and proceed with crawling. A lock file left
+  # behind by a crawl that was killed does not stop us, we resume that crawl.
 
   if os.path.exists(lockFile):
-    KastGenericFunctionsLib.logException(sitename + ' crawl in progress - Exiting - ' + str(time.time()), BASELOGDIR + sitename + '.exit.log')
-    sys.exit(-1)
+    if KastGenericFunctionsLib.isStaleLockFile(lockFile):
+      KastGenericFunctionsLib.logException(sitename + ' stale lock file found - Resuming crawl - ' + str(time.time()), BASELOGDIR + sitename + '.exit.log')
+    else:
+      KastGenericFunctionsLib.logException(sitename + ' crawl in progress - Exiting - ' + str(time.time()), BASELOGDIR + sitename + '.exit.log')
+      sys.exit(-1)
 
   # Make a lock file.
 
   if mode == 'p':
 
-    lf = file(lockFile, 'w')
-    lf.close()
+    KastGenericFunctionsLib.makeLockFile(lockFile)
 
   # Read the config file into a Dictionary/Hash structure.
 
@@ -457,45 +853,162 @@ def main(targetWebsite, configFile):
     KastGenericFunctionsLib.logException('Target website configs could not extracted - ' + str(time.time()), errorLog)
     sys.exit(-1)
 
-  # Obtain the list of URLs from the above data structure and generate time domain
-  # perfect series representation of html content.
+  # Obtain the list of URLs from the above data structure and train the model of the
+  # website on the time domain perfect series representation of their html content,
+  # unless a model trained on the same URLs was saved by an earlier run. Sample pages
+  # downloaded once are kept in BASESAMPLEDIR for retraining.
 
-  htmlSeries = [KastParsersLib.html2TagSignal(url) for url in targetWebsiteConfigs['SampleURLS']]
+  #
+  # With more kinds of pages to tell apart, the 'Templates' key maps the name of
+  # every template to its sample URLs, the sample URLs above being the 'sample'
+  # template, and every page is labeled with its nearest template instead, or as
+  # unknown if it is further from it than 'TemplateDistanceSlack' times the radius
+  # of the template. The pages of the 'InterestingTemplates' are of interest.
 
-  # Calculate the average similarity measure.
+  #
+  # A model is never trained on part of the samples, if one of them cannot be fetched
+  # the crawl does not start.
 
-  similarityMeasure = KastParsersLib.calculateThresholdDftDistanceScore(htmlSeries)
+  try:
 
-  # Populate the unseenUrlList
+    if 'Templates' in targetWebsiteConfigs:
+      templateUrls = {'sample' : targetWebsiteConfigs['SampleURLS']}
+      templateUrls.update(targetWebsiteConfigs['Templates'])
+      model = KastClassifierLib.loadOrTrainTemplateIndex(templateUrls, targetWebsiteConfigs.get('InterestingTemplates', INTERESTINGTEMPLATES), templateIndexFile, BASESAMPLEDIR,
+                                                         targetWebsiteConfigs.get('TemplateDistanceSlack', KastClassifierLib.TEMPLATEDISTANCESLACK))
+    else:
+      model = KastClassifierLib.loadOrTrainModel(targetWebsiteConfigs['SampleURLS'], modelFile, BASESAMPLEDIR)
 
-  unseenUrlList = KastParsersLib.populateUnseenUrlList(targetWebsite, unseenUrlList)
-  if unseenUrlList == []:
-    logException('Seed URL List is malformed. Crawl engine is exiting - ' + str(time.time()), errorLog)
+  except KastClassifierLib.SampleError, e:
+
+    KastGenericFunctionsLib.logException(str(e) + ' - Crawl engine is exiting - ' + str(time.time()), errorLog)
     sys.exit(-1)
 
-  # Start crawling
+  # Pages which are nothing like the samples are weeded out before they are scored.
+
+  if isinstance(model, KastClassifierLib.SpectralModel) and targetWebsiteConfigs.get('ClassifyCascade', CLASSIFYCASCADE):
+    model.cascade = KastClassifierLib.CascadeFilter(model,
+                      targetWebsiteConfigs.get('CascadeLengthRatio', KastClassifierLib.CASCADELENGTHRATIO),
+                      targetWebsiteConfigs.get('CascadeHistogramSlack', KastClassifierLib.CASCADEHISTOGRAMSLACK),
+                      targetWebsiteConfigs.get('CascadeSpectrumSlack', KastClassifierLib.CASCADESPECTRUMSLACK),
+                      targetWebsiteConfigs.get('CascadeTopK', KastClassifierLib.CASCADETOPK))
+
+  # Compile the URL filters.
+
+  includePatterns = KastParsersLib.compileUrlPatterns(targetWebsiteConfigs.get('IncludePatterns', []))
+  excludePatterns = KastParsersLib.compileUrlPatterns(targetWebsiteConfigs.get('ExcludePatterns', []))
+
+  # Open the page store of the site, the pages of earlier crawls are kept in it.
+
+  pageStore = KastCrawlerLib.PageStore(BASEFILESTORAGEDIR)
+
+  # And the SimHashes of the pages in it.
+
+  if targetWebsiteConfigs.get('NearDuplicates', NEARDUPLICATES):
+    nearDuplicates = KastCrawlerLib.loadSimHashIndex(nearDuplicatesFile, targetWebsiteConfigs.get('NearDuplicateDistance', KastCrawlerLib.NEARDUPLICATEDISTANCE))
+    nearDuplicateSimilarity = targetWebsiteConfigs.get('NearDuplicateSimilarity', KastCrawlerLib.NEARDUPLICATESIMILARITY)
+
+  # Open the frontier. With a disk frontier, if a previous crawl of this site did
+  # not finish we pick up where it stopped, else populate it with the seed URLs.
+
+  frontierMode = targetWebsiteConfigs.get('FrontierMode', FRONTIERMODE)
+  resuming = False
+
+  if frontierMode == 'disk':
+    resuming = os.path.exists(frontierFile)
+    frontier = KastCrawlerLib.PersistentUrlFrontier(frontierFile, checkpointEvery=CRAWLCHECKPOINTEVERY)
+  elif frontierMode == 'compact':
+    frontier = KastCrawlerLib.UrlFrontier(seen=KastCrawlerLib.FingerprintSet(targetWebsiteConfigs.get('ExpectedUrls', EXPECTEDURLS)))
+  else:
+    frontier = KastCrawlerLib.UrlFrontier()
+
+  if resuming:
+    KastGenericFunctionsLib.logException(sitename + ' resuming crawl, ' + str(frontier.crawled()) + ' pages crawled, ' + str(len(frontier)) + ' pages to go - ' + str(time.time()), BASELOGDIR + sitename + '.exit.log')
+  else:
+    seedUrlList = KastParsersLib.populateUnseenUrlList(targetWebsite, [], includePatterns, excludePatterns)
+    if seedUrlList == []:
+      KastGenericFunctionsLib.logException('Seed URL List is malformed. Crawl engine is exiting - ' + str(time.time()), errorLog)
+      frontier.close()
+      if frontierMode == 'disk':
+        os.remove(frontierFile)
+      sys.exit(-1)
+
+    for url in seedUrlList:
+      frontier.add(url)
+    frontier.checkpoint()
+
+  # Start crawling, with the site specific crawl engine settings if there are any.
+
+  classifyInline = targetWebsiteConfigs.get('ClassifyInline', CLASSIFYINLINE)
+
+  inlineModel = None
+  if classifyInline:
+    inlineModel = model
 
-  crawl(targetWebsite)
+  crawl(targetWebsite,
+        targetWebsiteConfigs.get('CrawlWorkers', CRAWLWORKERS),
+        targetWebsiteConfigs.get('CrawlDelay', CRAWLDELAY),
+        targetWebsiteConfigs.get('ConditionalGet', CONDITIONALGET),
+        inlineModel,
+        targetWebsiteConfigs.get('KeepUselessPages', KEEPUSELESSPAGES),
+        targetWebsiteConfigs.get('SkipDuplicateLinks', SKIPDUPLICATELINKS))
 
-  # Now apply the Page classification algorithm to preserve only the pages of interest.
+  # The crawl ran to completion, the next run starts afresh.
 
-  classify(htmlSeries, similarityMeasure)
+  frontier.close()
+  if frontierMode == 'disk':
+    os.remove(frontierFile)
+
+  # Now apply the Page classification algorithm to preserve only the pages of interest,
+  # unless that was done during the crawl.
+
+  if not classifyInline:
+    classify(model, targetWebsiteConfigs.get('ClassifyProcesses', CLASSIFYPROCESSES))
 
   # Apply the CSS rules for scrapping content, this will serve as a simple rule engine template.
 
   contentExtractionRules = targetWebsiteConfigs['ContentExtractionRules']
 
-  extractContent(contentExtractionRules)
+  extractContent(contentExtractionRules,
+                 targetWebsiteConfigs.get('ExtractProcesses', EXTRACTPROCESSES),
+                 targetWebsiteConfigs.get('ExtractOrdered', EXTRACTORDERED))
 
-  # Convert the log file into RDF N Triples file
+  pageStore.close()
+
+  # Now log all the information to AllegroGraphDB, all of it, straight from the log
+  # file or by way of an RDF N Triples file, into the default graph of a renewed store.
+  #
+  # Or, with 'LoadIncremental', only what changed since the last run. That changes
+  # the layout of the store: the triples of every record go into a named graph of
+  # its own, named after the GUID of the record, instead of the default graph, so
+  # queries have to look in all the graphs. Switching to it, or back, reloads the
+  # store in full.
 
   predicateList = targetWebsiteConfigs['PredicateList']
 
-  nTriplesFile = table2RDFNTriplesConverter(contentLogFile, predicateList)
+  if targetWebsiteConfigs.get('LoadIncremental', LOADINCREMENTAL):
 
-  # Now log all the information to AllegroGraphDB
+    upsertContentLog2db(contentLogFile, predicateList,
+                        targetWebsiteConfigs.get('LoadBatchSize', LOADBATCHSIZE),
+                        targetWebsiteConfigs.get('LoadWorkers', LOADWORKERS))
+
+  elif targetWebsiteConfigs.get('LoadDirect', LOADDIRECT):
+
+    loadContentLog2db(contentLogFile, predicateList,
+                      targetWebsiteConfigs.get('LoadBatchSize', LOADBATCHSIZE),
+                      targetWebsiteConfigs.get('LoadWorkers', LOADWORKERS))
+
+  else:
+
+    nTriplesFile = table2RDFNTriplesConverter(contentLogFile, predicateList, targetWebsiteConfigs.get('NTriplesGzip', NTRIPLESGZIP))
+
+    store2db(nTriplesFile)
+
+  # Done, release the lock.
+
+  if mode == 'p':
 
-  store2db(nTriplesFile)
+    os.remove(lockFile)
 
 # Make this as an executable script.
 
@@ -188,19 +188,31 @@ class Repository:
         else: raise Repository.UnsupportedFormatError(format)
 
     def loadData(self, data, format, baseURI=None, context=None):
+        if isinstance(data, unicode): data = data.encode("utf-8")
         nullRequest(self, "POST", "/statements?" + urlenc(context=context, baseURI=baseURI),
-                    data.encode("utf-8"), contentType=self.checkFormat(format))
-
-    def loadFile(self, file, format, baseURI=None, context=None, serverSide=False):
+                    data, contentType=self.checkFormat(format))
+
+    def loadFile(self, file, format, baseURI=None, context=None, serverSide=False, compress=False):
+        """Load a file into the repository. With serverSide, the server
+        reads the file itself. Otherwise the file is streamed to the
+        server in chunks, so memory use does not grow with its size. A
+        gzipped file is sent as it is, and when compress is True a plain
+        file is gzipped on the way, both with Content-Encoding gzip."""
         mime = self.checkFormat(format)
-        body = ""
-        if not serverSide:
-            f = open(file)
-            body = f.read()
+        if serverSide:
+            params = urlenc(file=file, context=context, baseURI=baseURI)
+            nullRequest(self, "POST", "/statements?" + params, "", contentType=mime)
+            return
+        f = open(file, "rb")
+        try:
+            body, encoding = f, None
+            if f.read(2) == "\x1f\x8b": encoding = "gzip"
+            f.seek(0)
+            if compress and encoding is None: body, encoding = GzipReader(f), "gzip"
+            params = urlenc(context=context, baseURI=baseURI)
+            nullRequest(self, "POST", "/statements?" + params, body, contentType=mime, contentEncoding=encoding)
+        finally:
             f.close()
-            file = None
-        params = urlenc(file=file, context=context, baseURI=baseURI)
-        nullRequest(self, "POST", "/statements?" + params, body, contentType=mime)
 
     def getBlankNodes(self, amount=1):
         return jsonRequest(self, "POST", "/blankNodes", urlenc(amount=amount))
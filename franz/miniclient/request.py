@@ -1,4 +1,4 @@
-import StringIO, pycurl, urllib, cjson, locale
+import StringIO, pycurl, urllib, cjson, locale, zlib
 
 from threading import Lock
 
@@ -50,7 +50,27 @@ def urlenc(**args):
         encval(name, val)
     return "&".join(buf)
 
-def makeRequest(obj, method, url, body=None, accept="*/*", contentType=None, callback=None, errCallback=None):
+CHUNKSIZE = 1 << 16
+
+class GzipReader:
+    """File-like wrapper that gzips the content of another file object
+    as it is read, a chunk at a time."""
+    def __init__(self, f, level=6):
+        self.f = f
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.buffer = ""
+        self.done = False
+    def read(self, size=CHUNKSIZE):
+        while len(self.buffer) < size and not self.done:
+            chunk = self.f.read(CHUNKSIZE)
+            if chunk: self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.done = True
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+def makeRequest(obj, method, url, body=None, accept="*/*", contentType=None, callback=None, errCallback=None, contentEncoding=None):
     curl = curlPool.get()
     if obj:
         if obj.user and obj.password:
@@ -59,14 +79,23 @@ def makeRequest(obj, method, url, body=None, accept="*/*", contentType=None, cal
         if url.startswith("/"): url = obj.url + url
 
     postbody = method == "POST" or method == "PUT"
+    # A body with a read method is streamed, libcurl pulls it through
+    # READFUNCTION and sends it with chunked transfer encoding, instead
+    # of the whole string being handed over in POSTFIELDS.
+    streaming = postbody and hasattr(body, "read")
+    curl.setopt(pycurl.UPLOAD, 0)
     curl.setopt(pycurl.POSTFIELDS, "")
-    if body:
+    if streaming:
+        curl.setopt(pycurl.READFUNCTION, body.read)
+    elif body:
         if postbody:
             curl.setopt(pycurl.POSTFIELDS, body)
         else:
             url = url + "?" + body
 
     curl.setopt(pycurl.POST, (postbody and 1) or 0)
+    # UPLOAD has to come after POST, the method is set by CUSTOMREQUEST.
+    if streaming: curl.setopt(pycurl.UPLOAD, 1)
     curl.setopt(pycurl.CUSTOMREQUEST, method)
     curl.setopt(pycurl.URL, url)
 
@@ -75,6 +104,8 @@ def makeRequest(obj, method, url, body=None, accept="*/*", contentType=None, cal
     # bodies.
     headers = ["Connection: keep-alive", "Accept: " + accept, "Expect:"]
     if contentType and postbody: headers.append("Content-Type: " + contentType)
+    if contentEncoding and postbody: headers.append("Content-Encoding: " + contentEncoding)
+    if streaming: headers.append("Transfer-Encoding: chunked")
     if callback: headers.append("Connection: close")
     curl.setopt(pycurl.HTTPHEADER, headers)
     curl.setopt(pycurl.ENCODING, "") # which means 'any encoding that curl supports'
@@ -116,8 +147,8 @@ def jsonRequest(obj, method, url, body=None, contentType="application/x-www-form
         def raiseErr(status, message): raise RequestError(status, message)
         makeRequest(obj, method, url, body, accept, contentType, callback=rowreader.process, errCallback=raiseErr)
 
-def nullRequest(obj, method, url, body=None, contentType="application/x-www-form-urlencoded"):
-    status, body = makeRequest(obj, method, url, body, "application/json", contentType)
+def nullRequest(obj, method, url, body=None, contentType="application/x-www-form-urlencoded", contentEncoding=None):
+    status, body = makeRequest(obj, method, url, body, "application/json", contentType, contentEncoding=contentEncoding)
     if (status < 200 or status > 204): raise RequestError(status, body)
 
 class RowReader:
@@ -76,3 +76,15 @@ class QueryMissingFeatureException(Exception):
     """
     Source language evokes a feature not supported by the execution language
     """
+
+class BulkLoadException(Exception):
+    """
+    One or more workers of a parallel bulk load failed.  'errors' maps the
+    number of every failed worker to its exception, 'loaded' holds the number
+    of quads every worker had added.
+    """
+    def __init__(self, errors, loaded):
+        Exception.__init__(self, "Bulk load failed in worker(s) %s: %s" %
+                           (sorted(errors.keys()), "; ".join(["%s: %s" % (i, errors[i]) for i in sorted(errors.keys())])))
+        self.errors = errors
+        self.loaded = loaded
@@ -27,7 +27,7 @@ from __future__ import absolute_import
 from .jdbcresultset import JDBCStatementResultSet
 from .repositoryresult import RepositoryResult
 
-from ..exceptions import IllegalOptionException, IllegalArgumentException
+from ..exceptions import IllegalOptionException, IllegalArgumentException, BulkLoadException
 from ..model import Statement, Value
 from ..model.literal import RangeLiteral, GeoCoordinate, GeoSpatialRegion, GeoBox, GeoCircle, GeoPolygon
 from ..query import query as query_module
@@ -38,6 +38,8 @@ from ..util import uris
 from ..vocabulary import RDF, RDFS, OWL, XMLSchema
 import datetime
 import os
+import threading
+import Queue
 
 
 
@@ -374,7 +376,8 @@ class RepositoryConnection(object):
         """
         Load the file or file path 'filePath' into the store.  'base' optionally defines a base URI,
         'format' is RDFFormat.NTRIPLES or RDFFormat.RDFXML, and 'context' optionally specifies
-        which context the triples will be loaded into.
+        which context the triples will be loaded into.  A gzipped file, such as a '.nt.gz',
+        is sent to the server compressed, unless it is loaded 'serverSide'.
         """
         if isinstance(filePath, file):
             filePath = os.path.abspath(filePath.name)
@@ -389,7 +392,7 @@ class RepositoryConnection(object):
                 raise IllegalArgumentException("Multiple contexts passed to 'addFile': %s" % context)
             context = context[0] if context else None
         contextString = self._context_to_ntriples(context, none_is_mini_null=True)
-        if format == RDFFormat.NTRIPLES or filePath.lower().endswith('.nt'):
+        if format == RDFFormat.NTRIPLES or filePath.lower().endswith('.nt') or filePath.lower().endswith('.nt.gz'):
             self._get_mini_repository().loadFile(filePath, 'ntriples', context=contextString, serverSide=serverSide)
         elif format == RDFFormat.RDFXML or filePath.lower().endswith('.rdf') or filePath.lower().endswith('.owl'):
             self._get_mini_repository().loadFile(filePath, 'rdf/xml', context=contextString, baseURI=base, serverSide=serverSide)
@@ -429,29 +432,96 @@ class RepositoryConnection(object):
         ntripleContexts = self._contexts_to_ntriple_contexts(context, none_is_mini_null=True)
         quads = []
         for q in triples_or_quads:
-            isQuad = len(q) == 4
-            quad = [None] * 4
-            if ntriples:
-                quad[0] = q[0]
-                quad[1] = q[1]
-                quad[2] = q[2]
-                quad[3] = q[3] if isQuad and q[3] else ntripleContexts
-            elif isinstance(quad, (list, tuple)):
-                predicate = q[1]
-                obj = self.getValueFactory().object_position_term_to_openrdf_term(q[2], predicate=predicate)
-                quad[0] = self._to_ntriples(q[0])
-                quad[1] = self._to_ntriples(predicate)
-                quad[2] = self._to_ntriples(obj)
-                quad[3] = self._to_ntriples(q[3]) if isQuad and q[3] else ntripleContexts
-            else: # must be a statement
-                predicate = q.getPredicate()
-                obj = self.getValueFactory().object_position_term_to_openrdf_term(q.getObject(), predicate=predicate)
-                quad[0] = self._to_ntriples(q.getSubject())
-                quad[1] = self._to_ntriples(predicate)
-                quad[2] = self._to_ntriples(obj)
-                quad[3] = self._to_ntriples(q.getContext()) if isQuad and q.getContext() else ntripleContexts
-            quads.append(quad)
+            quads.append(self._to_mini_quad(q, ntripleContexts, ntriples))
         self._get_mini_repository().addStatements(quads)
+
+    def _to_mini_quad(self, q, ntripleContexts, ntriples):
+        """
+        Convert a triple or quad to the quad of ntriples strings the mini
+        client sends, with 'ntripleContexts' as the context of a triple.
+        """
+        isQuad = len(q) == 4
+        quad = [None] * 4
+        if ntriples:
+            quad[0] = q[0]
+            quad[1] = q[1]
+            quad[2] = q[2]
+            quad[3] = q[3] if isQuad and q[3] else ntripleContexts
+        elif isinstance(quad, (list, tuple)):
+            predicate = q[1]
+            obj = self.getValueFactory().object_position_term_to_openrdf_term(q[2], predicate=predicate)
+            quad[0] = self._to_ntriples(q[0])
+            quad[1] = self._to_ntriples(predicate)
+            quad[2] = self._to_ntriples(obj)
+            quad[3] = self._to_ntriples(q[3]) if isQuad and q[3] else ntripleContexts
+        else: # must be a statement
+            predicate = q.getPredicate()
+            obj = self.getValueFactory().object_position_term_to_openrdf_term(q.getObject(), predicate=predicate)
+            quad[0] = self._to_ntriples(q.getSubject())
+            quad[1] = self._to_ntriples(predicate)
+            quad[2] = self._to_ntriples(obj)
+            quad[3] = self._to_ntriples(q.getContext()) if isQuad and q.getContext() else ntripleContexts
+        return quad
+
+    def addTriplesParallel(self, triples_or_quads, context=ALL_CONTEXTS, ntriples=False, workers=4, batchSize=10000, queueDepth=2):
+        """
+        Bulk load the supplied triples or quads, as addTriples does, over
+        'workers' concurrent requests.  The input is read once, as a stream,
+        and partitioned across worker threads by a hash of the subject, so
+        all the quads of a subject go through the same worker.  Each worker
+        sends its partition 'batchSize' quads a request, on a curl handle of
+        its own from the pool.  A worker queues at most 'queueDepth' batches,
+        and the caller waits once a queue is full, so the input is read only
+        as fast as the server takes it.  Returns the number of quads added.
+        Once a worker fails the input is no longer read, and after the other
+        workers are done a BulkLoadException reports the error of every
+        failed worker along with the quads each worker had added.
+        """
+        ntripleContexts = self._contexts_to_ntriple_contexts(context, none_is_mini_null=True)
+        mini = self._get_mini_repository()
+        queues = [Queue.Queue(queueDepth) for i in range(workers)]
+        loaded = [0] * workers
+        errors = {}
+
+        def work(i):
+            while True:
+                batch = queues[i].get()
+                if batch is None: return
+                ## after a failure keep draining, so the caller never blocks on us
+                if i in errors: continue
+                try:
+                    mini.addStatements(batch)
+                    loaded[i] += len(batch)
+                except Exception, e:
+                    errors[i] = e
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        partitions = [[] for i in range(workers)]
+        try:
+            for q in triples_or_quads:
+                quad = self._to_mini_quad(q, ntripleContexts, ntriples)
+                i = hash(quad[0]) % workers
+                partitions[i].append(quad)
+                if len(partitions[i]) >= batchSize:
+                    if errors: break
+                    queues[i].put(partitions[i])
+                    partitions[i] = []
+            else:
+                for i in range(workers):
+                    if partitions[i]: queues[i].put(partitions[i])
+        finally:
+            for i in range(workers):
+                queues[i].put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise BulkLoadException(errors, loaded)
+        return sum(loaded)
                 
 #     * Adds the supplied statement to this repository, optionally to one or more
 #     * named contexts.
@@ -13,8 +13,11 @@ from ..rio.rdfformat import RDFFormat
 from ..rio.rdfwriter import  NTriplesWriter
 from ..rio.rdfxmlwriter import RDFXMLWriter
 from ..model import URI, Literal
+from ..repository.repositoryconnection import RepositoryConnection
+from ..exceptions import BulkLoadException
 
-import os, urllib, datetime, time, locale
+import os, urllib, datetime, time, locale, threading, tempfile, gzip, zlib
+import BaseHTTPServer
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -1037,3 +1040,150 @@ def test_freetext():
     assert len(results)
     for result in results:
         print 'The Query Result:', result
+
+def test_addTriplesParallel():
+    """
+    Bulk load triples over several workers, then check every one made it.
+    """
+    conn = connect()
+    conn.clear()
+    name = '<http://example.org/ontology/name>'
+    triples = (('<http://example.org/people/p%d>' % i, name, '"Person %d"' % i) for i in range(10000))
+    count = conn.addTriplesParallel(triples, ntriples=True, workers=4, batchSize=500)
+    verify(count, 10000, 'count', 'addTriplesParallel')
+    verify(conn.size(), 10000, 'conn.size()', 'addTriplesParallel')
+
+class StubMiniRepository(object):
+    """
+    Stands in for a mini repository in the tests of addTriplesParallel, no
+    server needed.  Records the thread every quad was sent from, takes
+    'delay' seconds a request and fails the requests of 'failWorker'.
+    """
+    def __init__(self, workers, delay=0.005, failWorker=None):
+        self.workers = workers
+        self.delay = delay
+        self.failWorker = failWorker
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.sent = 0
+        self.read = 0
+        self.maxAhead = 0
+
+    def addStatements(self, quads):
+        time.sleep(self.delay)
+        if self.failWorker is not None and hash(quads[0][0]) % self.workers == self.failWorker:
+            raise Exception('stub failure')
+        self.lock.acquire()
+        try:
+            for quad in quads:
+                self.threads.setdefault(quad[0], set()).add(threading.currentThread())
+            self.sent += len(quads)
+            self.maxAhead = max(self.maxAhead, self.read - self.sent)
+        finally:
+            self.lock.release()
+
+class StubRepository(object):
+    def __init__(self, mini):
+        self.mini = mini
+    def _get_mini_repository(self):
+        return self.mini
+
+def stub_triples(mini, count):
+    for i in xrange(count):
+        mini.read += 1
+        yield ('<http://example.org/s%d>' % (i // 3), '<http://example.org/p%d>' % (i % 3), '"%d"' % i)
+
+def test_addTriplesParallel_partitions():
+    """
+    Every quad is sent once, all the quads of a subject from the same worker,
+    and the input is never read more than the queues hold ahead of the uploads.
+    """
+    workers, batchSize, queueDepth = 4, 50, 1
+    mini = StubMiniRepository(workers)
+    conn = RepositoryConnection(StubRepository(mini))
+    count = conn.addTriplesParallel(stub_triples(mini, 6000), ntriples=True, workers=workers, batchSize=batchSize, queueDepth=queueDepth)
+    assert count == 6000 and mini.sent == 6000
+    assert len(mini.threads) == 2000
+    assert max([len(threads) for threads in mini.threads.values()]) == 1
+    assert len(set.union(*mini.threads.values())) == workers
+    ## per worker: a batch being sent, the queued ones and the partition being filled
+    assert mini.maxAhead <= workers * (queueDepth + 2) * batchSize
+
+def test_addTriplesParallel_failure():
+    """
+    A failing worker stops the input from being read, and is reported with
+    its error, along with the quads every worker added.
+    """
+    workers = 4
+    mini = StubMiniRepository(workers, failWorker=2)
+    conn = RepositoryConnection(StubRepository(mini))
+    try:
+        conn.addTriplesParallel(stub_triples(mini, 100000), ntriples=True, workers=workers, batchSize=50, queueDepth=1)
+        assert False, 'BulkLoadException expected'
+    except BulkLoadException, e:
+        assert e.errors.keys() == [2]
+        assert str(e.errors[2]) == 'stub failure'
+        assert len(e.loaded) == workers and e.loaded[2] == 0
+        assert sum(e.loaded) == mini.sent
+    assert mini.read < 100000 / 10
+
+class StubStatementsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Takes the POSTs of statements to a stub server, chunked or not, and keeps
+    their headers and their body, decompressed if it was gzipped.
+    """
+    protocol_version = 'HTTP/1.1'
+    posts = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        StubStatementsHandler.posts.append((self.path, dict(self.headers), body))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+
+def test_addFile_gzip():
+    """
+    A gzipped N-Triples file is streamed to the server as it is, with
+    Content-Encoding gzip, and arrives intact.
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubStatementsHandler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.setDaemon(True)
+    thread.start()
+    ntriples = ''.join(['<http://example.org/s%d> <http://example.org/p> "%d" .\n' % (i, i) for i in range(10000)])
+    fd, path = tempfile.mkstemp(suffix='.nt.gz')
+    os.close(fd)
+    try:
+        f = gzip.open(path, 'wb')
+        f.write(ntriples)
+        f.close()
+        mini = repository.Repository('http://127.0.0.1:%d/repositories/test' % server.server_address[1])
+        conn = RepositoryConnection(StubRepository(mini))
+        conn.add(path)
+        thread.join()
+        url, headers, body = StubStatementsHandler.posts[-1]
+        assert headers.get('content-encoding') == 'gzip'
+        assert headers.get('transfer-encoding') == 'chunked'
+        assert body == ntriples
+    finally:
+        os.remove(path)
+        server.server_close()